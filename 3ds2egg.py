@@ -8,23 +8,92 @@
     .___..__ .___.___.___.__..__ .  .
       |  [__)[__ [__ [__ |  |[__)|\/|
       |  |  \[___[___|   |__||  \|  |
-    obj2egg.py [n##][b][t][s] filename1.3ds ...
+    obj2egg.py [n##][b][t][s][m][d][j#][c dir][w#][e][g][N][q][v][o name][l][p dir][J#][i][F][r] filename1.3ds ...
         -n regenerate normals with # degree smoothing
             exaple -n30  (normals at less 30 degrees will be smoothed)
         -b make binarmals
         -t make tangents
+            (-b and -t are the same: both make tangents and binormals, with
+            the smoothing group normals of -N; --pandabinormals has panda
+            recompute them on the finished egg instead)
         -s show in pview
+        -m memory-map the input rather than reading it
+        -d dump the chunk tree while reading (logged at debug level)
+        -j convert # files at a time, each in its own process
+            example -j8  (a summary of all files is printed at the end)
+        -c reuse earlier conversions kept in the cache directory #
+            example -c ~/.3ds2egg  (--cache-size=MB bounds it, default 1024)
+        -w also weld vertices no further apart than #
+            example -w0.0001  (--noweld gives each face corner its own vertex)
+        -e stream egg text straight to the file (no panda needed; this is
+            the default when panda can't be imported)
+        -g write binary geometry (.3dg, see GeomWriter) instead of an egg
+        -N make vertex normals from the .3ds smoothing groups, as max does
+        --profile=file.json  write per-phase and per-chunk timings as json
+            (files taken from the -c cache are left out of it)
+        -q only log warnings and errors (the summary is still printed)
+        -v log everything, the chunk tree included
+        -o convert only the named object, and the materials it uses
+            (may be given more than once; the file is memory-mapped)
+        --index  keep an index of object and material offsets in a
+            filename.3ds.idx sidecar, so later -o runs skip the scan
+        -l read the file one object at a time, for files larger than
+            memory (implies -e unless -g; -o maps the file instead)
+        -p also look for texture maps in this directory (may be given
+            more than once; the .3ds file's own directory comes first)
+        --nodedup  keep materials that only differ by name apart (by
+            default they become one material, and each map one texture)
+        --matlib=file.json  name materials and textures alike across
+            all the files converted with the same library
+        --pipeline  with several files (and no -j), read the next files
+            and write out the last ones while converting the current one
+        -J convert the objects of a file on # processes (not with -j,
+            -l or -i)
+        -i make the mesh of an object that repeats an earlier one (up to
+            its mesh matrix) only once, and an <Instance> of it for each
+            copy (INST records with -g)
+        -F flatten the scene: merge the objects into one mesh per
+            material, of at most --vertexcap=# vertices each (default
+            65535; implies -e unless -g, and -i is not used)
+        -r reorder each material's triangles for the vertex cache, and
+            number the vertices in the order they are used (the average
+            cache miss ratio, before and after, is logged per object)
+        --lod=d0,d1,...  give each object levels of detail, seen out to
+            each distance in turn: the full mesh up to d0, then (by
+            edge collapse) half the triangles up to d1, and so on
+            (--lodratio=# sets the half; -F and -i are not used)
 
     licensed under WTFPL (http://sam.zoy.org/wtfpl/)
 """
 
-from pandac.PandaModules import *
+try:
+    from pandac.PandaModules import *
+    HAVE_PANDA = True
+except ImportError:
+    # without panda, only the streaming egg writer (-e) is available
+    HAVE_PANDA = False
 import struct
+import array
+import mmap
 import math
 import string
 import getopt
+import re
+import time
+import hashlib
+import json
+import shutil
+import logging
+import cStringIO
+import heapq
 import sys, os
 
+log = logging.getLogger("3ds2egg")
+# the chunk tree gets a logger of its own, so -d can turn just it on
+chunklog = logging.getLogger("3ds2egg.chunks")
+# stay silent when imported by something that never configures logging
+log.addHandler(logging.NullHandler())
+
 
 def floats(float_list):
     """coerce a list of strings that represent floats into a list of floats"""
@@ -34,7 +103,779 @@ def ints(int_list):
     """coerce a list of strings that represent integers into a list of integers"""
     return [ int(number) for number in int_list ]
 
-class TDSChunk:
+def unpackarray(typecode, data, base, count):
+    """bulk-decode count little-endian items of typecode at data[base:]"""
+    arr = array.array(typecode)
+    arr.fromstring(buffer(data, base, count * arr.itemsize))
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+def readasciz(data, base):
+    """return (string, offset past the nul) for the asciz at data[base:]"""
+    end = data.find("\0", base)
+    if end < 0:
+        end = len(data)
+    return data[base:end], end + 1
+
+def chunkheaders(data, base, limit):
+    """yield (base, id, length) for each chunk header from base up to
+    limit, without making any chunk objects"""
+    if (limit - base) < 6:
+        return
+    while base < limit:
+        id, length = struct.unpack_from("<HI", data, base)
+        if length < 6:
+            # a corrupt length would otherwise never advance
+            return
+        yield base, id, length
+        base += length
+
+def packarray(arr):
+    """the little-endian bytes of a typed array"""
+    if sys.byteorder == "big":
+        arr = array.array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tostring()
+
+class TupleView:
+    """a read-only list-of-tuples view over a flat typed array.
+
+    the decoders keep their payload in flat arrays; this is here for
+    code that still wants points[i] -> (x, y, z) and friends."""
+    def __init__(self, arr, width):
+        self.array = arr
+        self.width = width
+
+    def __len__(self):
+        return len(self.array) // self.width
+
+    def __getitem__(self, i):
+        n = len(self)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError("TupleView index out of range")
+        base = i * self.width
+        return tuple(self.array[base:base + self.width])
+
+    def __iter__(self):
+        for i in xrange(0, len(self)):
+            yield self[i]
+
+    def tolist(self):
+        return list(self)
+
+def facenormals(points, faces):
+    """the area-weighted (ie, unnormalized) normal of every face, as a
+    flat array of 3 floats per face"""
+    normals = array.array("f", [0.0]) * (len(faces) // 4 * 3)
+    n = 0
+    for f in xrange(0, len(faces), 4):
+        a = faces[f] * 3
+        b = faces[f + 1] * 3
+        c = faces[f + 2] * 3
+        ax, ay, az = points[a], points[a + 1], points[a + 2]
+        ux, uy, uz = points[b] - ax, points[b + 1] - ay, points[b + 2] - az
+        vx, vy, vz = points[c] - ax, points[c + 1] - ay, points[c + 2] - az
+        normals[n] = uy * vz - uz * vy
+        normals[n + 1] = uz * vx - ux * vz
+        normals[n + 2] = ux * vy - uy * vx
+        n += 3
+    return normals
+
+def smoothnormals(points, faces, smoothing=None):
+    """per-corner normals (9 floats per face) from the smoothing groups.
+
+    this follows 3ds max: a corner's normal is the sum of the normals
+    of the faces around its point that share a smoothing group bit with
+    its own face, and a face in no group (or with no smoothing array at
+    all) is flat shaded. face normals are summed once per (point,
+    group mask), so the work is linear in the face count."""
+    nfaces = len(faces) // 4
+    fnormals = facenormals(points, faces)
+    if smoothing is None or len(smoothing) < nfaces:
+        smoothing = array.array("I", [0]) * nfaces
+    # accumulate face normals per (point, mask)
+    sums = {}
+    masksbypoint = {}
+    for f in xrange(0, nfaces):
+        mask = smoothing[f]
+        if mask == 0:
+            continue
+        nx, ny, nz = fnormals[f * 3:f * 3 + 3]
+        for v in faces[f * 4:f * 4 + 3]:
+            key = (v, mask)
+            acc = sums.get(key)
+            if acc is None:
+                sums[key] = [nx, ny, nz]
+                masksbypoint.setdefault(v, []).append(mask)
+            else:
+                acc[0] += nx
+                acc[1] += ny
+                acc[2] += nz
+    # then resolve each (point, mask) against the other masks at that
+    # point; many corners share the result
+    resolved = {}
+    normals = array.array("f")
+    for f in xrange(0, nfaces):
+        mask = smoothing[f]
+        for v in faces[f * 4:f * 4 + 3]:
+            if mask == 0:
+                nx, ny, nz = fnormals[f * 3:f * 3 + 3]
+            else:
+                n = resolved.get((v, mask))
+                if n is None:
+                    nx = ny = nz = 0.0
+                    for other in masksbypoint[v]:
+                        if other & mask:
+                            acc = sums[(v, other)]
+                            nx += acc[0]
+                            ny += acc[1]
+                            nz += acc[2]
+                    n = resolved[(v, mask)] = (nx, ny, nz)
+                nx, ny, nz = n
+            length = math.sqrt(nx * nx + ny * ny + nz * nz)
+            if length > 0.0:
+                normals.extend((nx / length, ny / length, nz / length))
+            else:
+                normals.extend((0.0, 0.0, 1.0))
+    return normals
+
+# a .3ds mesh matrix is 12 floats: the x, y and z axes of the object's
+# local space, then its origin, all in world space
+IDENTITY_MATRIX = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0)
+
+def invertmatrix(m):
+    """the inverse of a mesh matrix, or None if it is singular"""
+    x, y, z, o = m[0:3], m[3:6], m[6:9], m[9:12]
+    def cross(a, b):
+        return (a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0])
+    def dot(a, b):
+        return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+    # the rows of the inverse of the axes
+    rows = [ cross(y, z), cross(z, x), cross(x, y) ]
+    det = dot(x, rows[0])
+    if det == 0.0:
+        return None
+    rows = [ (r[0] / det, r[1] / det, r[2] / det) for r in rows ]
+    inverse = []
+    for k in (0, 1, 2):
+        inverse.extend((rows[0][k], rows[1][k], rows[2][k]))
+    inverse.extend((-dot(rows[0], o), -dot(rows[1], o), -dot(rows[2], o)))
+    return tuple(inverse)
+
+def multiplymatrix(a, b):
+    """the mesh matrix that applies b, then a"""
+    product = []
+    for k in (0, 3, 6, 9):
+        x, y, z = b[k:k + 3]
+        product.extend((x * a[0] + y * a[3] + z * a[6],
+                        x * a[1] + y * a[4] + z * a[7],
+                        x * a[2] + y * a[5] + z * a[8]))
+    for k in (0, 1, 2):
+        product[9 + k] += a[9 + k]
+    return tuple(product)
+
+def transformpoints(m, points):
+    """a flat point array put through a mesh matrix"""
+    result = array.array("f")
+    for p in xrange(0, len(points), 3):
+        x, y, z = points[p], points[p + 1], points[p + 2]
+        result.extend((x * m[0] + y * m[3] + z * m[6] + m[9],
+                       x * m[1] + y * m[4] + z * m[7] + m[10],
+                       x * m[2] + y * m[5] + z * m[8] + m[11]))
+    return result
+
+# the post-transform vertex cache modelled by vertexcacheorder (an LRU
+# cache, as in Forsyth's "Linear-Speed Vertex Cache Optimisation"), and
+# the FIFO cache vertexcachemisses measures against, as on most hardware
+FORSYTH_CACHE_SIZE = 32
+FIFO_CACHE_SIZE = 16
+
+def vertexcachemisses(triangles, first=0, count=None, cachesize=FIFO_CACHE_SIZE):
+    """the vertex cache misses of drawing count triangles (3 vertex
+    indices each) from first on, through a FIFO cache"""
+    if count is None:
+        count = len(triangles) // 3 - first
+    cached = {}
+    fifo = []
+    misses = 0
+    for v in triangles[first * 3:(first + count) * 3]:
+        if cached.has_key(v):
+            continue
+        misses += 1
+        cached[v] = True
+        fifo.append(v)
+        if len(fifo) > cachesize:
+            del cached[fifo.pop(0)]
+    return misses
+
+def vertexcacheorder(triangles, first, count):
+    """the order (a list of triangle numbers) to draw count triangles
+    from first on in, for a vertex cache, by Forsyth's algorithm: the
+    next triangle is always the best scoring one, where vertices score
+    for being recently used, and for having few triangles left."""
+    cachesize = FORSYTH_CACHE_SIZE
+    # score by cache position, and by the triangles a vertex has left
+    cachescore = [ 0.75, 0.75, 0.75 ] + [ (1.0 - (i - 3) / float(cachesize - 3)) ** 1.5 for i in xrange(3, cachesize) ]
+    tris = [ tuple(triangles[t * 3:t * 3 + 3]) for t in xrange(first, first + count) ]
+    # the triangles not yet drawn around each vertex
+    adjacent = {}
+    for t in xrange(0, count):
+        for v in tris[t]:
+            adjacent.setdefault(v, []).append(t)
+    valencescore = [ -1.0 ] + [ 2.0 * n ** -0.5 for n in xrange(1, max([ len(ts) for ts in adjacent.values() ] + [ 0 ]) + 1) ]
+    vscore = dict([ (v, valencescore[len(ts)]) for v, ts in adjacent.items() ])
+    # begin with the best triangle of all
+    tscore = [ vscore[a] + vscore[b] + vscore[c] for a, b, c in tris ]
+    done = [ False ] * count
+    order = []
+    cache = []
+    best = -1
+    if count > 0:
+        best = max(xrange(0, count), key=tscore.__getitem__)
+    # where to look for a triangle when the cache has nothing to offer
+    scan = 0
+    while len(order) < count:
+        if best < 0:
+            while done[scan]:
+                scan += 1
+            best = scan
+        t = best
+        done[t] = True
+        order.append(first + t)
+        tri = tris[t]
+        for v in tri:
+            adjacent[v].remove(t)
+        head = []
+        for v in tri:
+            if v not in head:
+                head.append(v)
+        cache = head + [ v for v in cache if v not in tri ]
+        for i in xrange(0, len(cache)):
+            v = cache[i]
+            n = len(adjacent[v])
+            if n == 0:
+                vscore[v] = -1.0
+            elif i < cachesize:
+                vscore[v] = cachescore[i] + valencescore[n]
+            else:
+                vscore[v] = valencescore[n]
+        # rescore the triangles around the cache, and pick the best
+        best = -1
+        bestscore = -1.0
+        for v in cache:
+            for u in adjacent[v]:
+                a, b, c = tris[u]
+                score = vscore[a] + vscore[b] + vscore[c]
+                if score > bestscore:
+                    best = u
+                    bestscore = score
+        del cache[cachesize:]
+    return order
+
+
+# the offsets of an epsilon cell and the 26 cells around it, which
+# between them hold every point within epsilon of a point in the cell
+NEIGHBOUR_CELLS = [ (dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1) ]
+
+class TriMesh:
+    """an indexed triangle mesh with welded vertices.
+
+    each vertex is one unique corner of the source faces, and is kept
+    in flat arrays: positions (3 floats), uvs (2 floats, if any),
+    normals, tangents and binormals (3 floats each, if any).
+    sources maps a vertex back to its point in the POINT_ARRAY, and
+    triangles holds 3 vertex indices per triangle, with facenums giving
+    the source face number of each triangle. the triangles are sorted
+    by material, and batches holds a (material name, first triangle,
+    triangle count) range for each material."""
+    def __init__(self, name=None):
+        self.name = name
+        self.positions = array.array("f")
+        self.uvs = None
+        self.normals = None
+        self.tangents = None
+        self.binormals = None
+        self.sources = array.array("I")
+        self.triangles = array.array("I")
+        self.facenums = array.array("I")
+        self.batches = []
+        # (misses before, misses after) of optimizeVertexCache
+        self.cachemisses = None
+        # coarser copies of the mesh, made by decimate, for an LOD chain
+        self.levels = None
+
+    def getNumVertices(self):
+        return len(self.sources)
+
+    def getNumTriangles(self):
+        return len(self.facenums)
+
+    def weld(self, points, uvs, faces, weld=True, epsilon=None, facenums=None, cornernormals=None):
+        """build the mesh from flat point, uv and face arrays.
+
+        corners that share a point (and normal, given per-corner
+        cornernormals) share a vertex; with an epsilon, a corner shares
+        the first vertex at most epsilon away with the same uv and
+        normal. without weld, every corner gets its own vertex. the
+        triangles follow the order of facenums, if given, and all in one
+        batch otherwise."""
+        hasuvs = len(uvs) > 0
+        if hasuvs:
+            self.uvs = array.array("f")
+        if cornernormals is not None:
+            self.normals = array.array("f")
+        index = {}
+        if epsilon:
+            # vertices by epsilon cell: anything within epsilon of a
+            # corner is in its cell or one of the 26 around it
+            cells = {}
+            near = epsilon * epsilon
+        positions = self.positions
+        sources = self.sources
+        triangles = self.triangles
+        if facenums is None:
+            facenums = xrange(0, len(faces) // 4)
+            self.batches = [ (None, 0, len(facenums)) ]
+        for f in facenums:
+            for k in (0, 1, 2):
+                v = faces[f * 4 + k]
+                if not weld:
+                    key = len(sources)
+                elif epsilon:
+                    p = v * 3
+                    x, y, z = points[p], points[p + 1], points[p + 2]
+                    cell = (int(math.floor(x / epsilon)),
+                            int(math.floor(y / epsilon)),
+                            int(math.floor(z / epsilon)))
+                    key = (v,)
+                    if hasuvs:
+                        key += (uvs[v * 2], uvs[v * 2 + 1])
+                else:
+                    key = (v,)
+                if cornernormals is not None:
+                    n = f * 9 + k * 3
+                    normal = cornernormals[n:n + 3]
+                    if weld:
+                        key += tuple(normal)
+                # (with an epsilon, index only remembers where each
+                # point went, and the cells are searched for the rest)
+                i = index.get(key)
+                if i is None and weld and epsilon:
+                    for dx, dy, dz in NEIGHBOUR_CELLS:
+                        for j, other in cells.get((cell[0] + dx, cell[1] + dy, cell[2] + dz), ()):
+                            if other != key[1:]:
+                                continue
+                            q = sources[j] * 3
+                            d = (points[q] - x) ** 2 + (points[q + 1] - y) ** 2 + (points[q + 2] - z) ** 2
+                            if d <= near and (i is None or j < i):
+                                i = j
+                    if i is not None:
+                        index[key] = i
+                if i is None:
+                    i = len(sources)
+                    index[key] = i
+                    if weld and epsilon:
+                        cells.setdefault(cell, []).append((i, key[1:]))
+                    sources.append(v)
+                    positions.extend(points[v * 3:v * 3 + 3])
+                    if hasuvs:
+                        self.uvs.extend(uvs[v * 2:v * 2 + 2])
+                    if cornernormals is not None:
+                        self.normals.extend(normal)
+                triangles.append(i)
+            self.facenums.append(f)
+        return self
+
+    def computeTangents(self):
+        """give every vertex a tangent and binormal, in the manner of
+        mikktspace.
+
+        each triangle's uv-derived tangent is projected into the plane
+        of each corner's normal and summed, weighted by the corner
+        angle, per vertex. since the vertices are already split at uv
+        seams and smoothing boundaries, so are the tangents; a vertex
+        shared by corners of opposite handedness (mirrored uvs) is
+        split once more. needs uvs and normals."""
+        if self.uvs is None or self.normals is None:
+            return self
+        positions = self.positions
+        uvs = self.uvs
+        normals = self.normals
+        triangles = self.triangles
+        sums = {}
+        signs = array.array("b")
+        for c in xrange(0, len(triangles), 3):
+            tri = triangles[c:c + 3]
+            a = tri[0] * 3
+            b = tri[1] * 3
+            d = tri[2] * 3
+            e1x, e1y, e1z = positions[b] - positions[a], positions[b + 1] - positions[a + 1], positions[b + 2] - positions[a + 2]
+            e2x, e2y, e2z = positions[d] - positions[a], positions[d + 1] - positions[a + 1], positions[d + 2] - positions[a + 2]
+            u0, v0 = uvs[tri[0] * 2], uvs[tri[0] * 2 + 1]
+            du1, dv1 = uvs[tri[1] * 2] - u0, uvs[tri[1] * 2 + 1] - v0
+            du2, dv2 = uvs[tri[2] * 2] - u0, uvs[tri[2] * 2 + 1] - v0
+            det = du1 * dv2 - du2 * dv1
+            if det == 0.0:
+                # no uv area, so no tangent to contribute
+                tx = ty = tz = 0.0
+                sign = 1
+            else:
+                r = 1.0 / det
+                tx, ty, tz = (e1x * dv2 - e2x * dv1) * r, (e1y * dv2 - e2y * dv1) * r, (e1z * dv2 - e2z * dv1) * r
+                bx, by, bz = (e2x * du1 - e1x * du2) * r, (e2y * du1 - e1y * du2) * r, (e2z * du1 - e1z * du2) * r
+            for k in (0, 1, 2):
+                v = tri[k]
+                n = v * 3
+                nx, ny, nz = normals[n], normals[n + 1], normals[n + 2]
+                if det != 0.0:
+                    # handedness of (normal, tangent, binormal)
+                    cx, cy, cz = ny * tz - nz * ty, nz * tx - nx * tz, nx * ty - ny * tx
+                    if cx * bx + cy * by + cz * bz < 0.0:
+                        sign = -1
+                    else:
+                        sign = 1
+                signs.append(sign)
+                acc = sums.get((v, sign))
+                if acc is None:
+                    acc = sums[(v, sign)] = [0.0, 0.0, 0.0]
+                # project into the tangent plane at this corner
+                dot = nx * tx + ny * ty + nz * tz
+                px, py, pz = tx - nx * dot, ty - ny * dot, tz - nz * dot
+                length = math.sqrt(px * px + py * py + pz * pz)
+                if length == 0.0:
+                    continue
+                # weight by the angle at this corner
+                q = tri[(k + 1) % 3] * 3
+                o = tri[(k + 2) % 3] * 3
+                ax, ay, az = positions[q] - positions[n], positions[q + 1] - positions[n + 1], positions[q + 2] - positions[n + 2]
+                bx2, by2, bz2 = positions[o] - positions[n], positions[o + 1] - positions[n + 1], positions[o + 2] - positions[n + 2]
+                la = math.sqrt(ax * ax + ay * ay + az * az)
+                lb = math.sqrt(bx2 * bx2 + by2 * by2 + bz2 * bz2)
+                if la == 0.0 or lb == 0.0:
+                    continue
+                cosine = (ax * bx2 + ay * by2 + az * bz2) / (la * lb)
+                weight = math.acos(max(-1.0, min(1.0, cosine))) / length
+                acc[0] += px * weight
+                acc[1] += py * weight
+                acc[2] += pz * weight
+        # split the vertices used with both handednesses
+        vertexbykey = {}
+        for c in xrange(0, len(triangles)):
+            v = triangles[c]
+            key = (v, signs[c])
+            i = vertexbykey.get(key)
+            if i is None:
+                if vertexbykey.has_key((v, -signs[c])):
+                    i = self.duplicateVertex(v)
+                else:
+                    i = v
+                vertexbykey[key] = i
+            triangles[c] = i
+        self.tangents = array.array("f", [0.0]) * len(self.positions)
+        self.binormals = array.array("f", [0.0]) * len(self.positions)
+        for key, i in vertexbykey.items():
+            v, sign = key
+            tx, ty, tz = sums[key]
+            n = i * 3
+            nx, ny, nz = normals[n], normals[n + 1], normals[n + 2]
+            length = math.sqrt(tx * tx + ty * ty + tz * tz)
+            if length == 0.0:
+                # any direction in the tangent plane will do
+                if abs(nx) < 0.9:
+                    tx, ty, tz = 0.0, nz, -ny
+                else:
+                    tx, ty, tz = -nz, 0.0, nx
+                length = math.sqrt(tx * tx + ty * ty + tz * tz)
+            tx, ty, tz = tx / length, ty / length, tz / length
+            self.tangents[n:n + 3] = array.array("f", (tx, ty, tz))
+            self.binormals[n:n + 3] = array.array("f", ((ny * tz - nz * ty) * sign,
+                                                        (nz * tx - nx * tz) * sign,
+                                                        (nx * ty - ny * tx) * sign))
+        return self
+
+    def optimizeVertexCache(self):
+        """reorder the triangles of each batch for the vertex cache
+        (see vertexcacheorder), then number the vertices in the order
+        the triangles first use them, for locality in fetching them.
+        cachemisses is set to the cache misses before and after."""
+        triangles = self.triangles
+        before = vertexcachemisses(triangles)
+        order = []
+        for name, first, count in self.batches:
+            order.extend(vertexcacheorder(triangles, first, count))
+        reordered = array.array("I")
+        facenums = array.array("I")
+        for t in order:
+            reordered.extend(triangles[t * 3:t * 3 + 3])
+            facenums.append(self.facenums[t])
+        # new vertex number -> old, first use first, then any unused
+        renumber = {}
+        vertices = []
+        for v in reordered:
+            if not renumber.has_key(v):
+                renumber[v] = len(vertices)
+                vertices.append(v)
+        for v in xrange(0, len(self.sources)):
+            if not renumber.has_key(v):
+                renumber[v] = len(vertices)
+                vertices.append(v)
+        self.triangles = array.array("I", [ renumber[v] for v in reordered ])
+        self.facenums = facenums
+        self.sources = array.array("I", [ self.sources[v] for v in vertices ])
+        for key, width in (("positions", 3), ("uvs", 2), ("normals", 3), ("tangents", 3), ("binormals", 3)):
+            values = getattr(self, key)
+            if values is None:
+                continue
+            permuted = array.array("f")
+            for v in vertices:
+                permuted.extend(values[v * width:v * width + width])
+            setattr(self, key, permuted)
+        self.cachemisses = (before, vertexcachemisses(self.triangles))
+        return self
+
+    def getCenter(self):
+        """the center of the mesh's bounding box"""
+        positions = self.positions
+        if len(positions) == 0:
+            return (0.0, 0.0, 0.0)
+        return tuple([ (min(positions[k::3]) + max(positions[k::3])) * 0.5 for k in (0, 1, 2) ])
+
+    def decimate(self, targets, smoothing=None):
+        """simplified copies of the mesh, one for each triangle count in
+        targets (or as near to it as can be had), by quadric error edge
+        collapse, after Garland and Heckbert.
+
+        each edge is collapsed onto one of its ends, so the vertices
+        that are left keep their uvs, normals and tangents as they are.
+        a vertex on the border of the mesh, on a uv or normal seam (its
+        position shared with another vertex), between materials, or
+        between smoothing groups (given the face smoothing masks) is
+        never moved, only collapsed onto. collapses that would fold a
+        triangle over, or pinch the surface, are not made."""
+        ntris = self.getNumTriangles()
+        nverts = len(self.sources)
+        points = [ tuple(self.positions[v * 3:v * 3 + 3]) for v in xrange(0, nverts) ]
+        tris = [ list(self.triangles[t * 3:t * 3 + 3]) for t in xrange(0, ntris) ]
+        batchof = array.array("I", [0]) * ntris
+        for b in xrange(0, len(self.batches)):
+            name, first, count = self.batches[b]
+            for t in xrange(first, first + count):
+                batchof[t] = b
+        vtris = [ set() for v in xrange(0, nverts) ]
+        edges = {}
+        for t in xrange(0, ntris):
+            tri = tris[t]
+            for k in (0, 1, 2):
+                vtris[tri[k]].add(t)
+                a, b = tri[k], tri[(k + 1) % 3]
+                key = (min(a, b), max(a, b))
+                edges[key] = edges.get(key, 0) + 1
+        # the vertices that stay where they are: on an edge of just
+        # one triangle, at a position of several vertices, or between
+        # batches or smoothing groups
+        locked = [ False ] * nverts
+        for (a, b), n in edges.items():
+            if n == 1:
+                locked[a] = locked[b] = True
+        byposition = {}
+        for v in xrange(0, nverts):
+            byposition.setdefault(points[v], []).append(v)
+        for vs in byposition.values():
+            if len(vs) > 1:
+                for v in vs:
+                    locked[v] = True
+        for v in xrange(0, nverts):
+            if len(set([ batchof[t] for t in vtris[v] ])) > 1:
+                locked[v] = True
+            elif smoothing is not None:
+                masks = set([ smoothing[self.facenums[t]] for t in vtris[v] if self.facenums[t] < len(smoothing) ])
+                if len(masks) > 1:
+                    locked[v] = True
+        def normal(a, b, c):
+            ux, uy, uz = b[0] - a[0], b[1] - a[1], b[2] - a[2]
+            vx, vy, vz = c[0] - a[0], c[1] - a[1], c[2] - a[2]
+            return (uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx)
+        # the error quadric of each vertex, as the 10 distinct terms of
+        # a symmetric 4x4 matrix, summed from its triangles' planes
+        # weighted by area
+        quadrics = [ [ 0.0 ] * 10 for v in xrange(0, nverts) ]
+        # and the unit normal each triangle had to begin with
+        normals = []
+        for tri in tris:
+            nx, ny, nz = normal(points[tri[0]], points[tri[1]], points[tri[2]])
+            length = math.sqrt(nx * nx + ny * ny + nz * nz)
+            if length == 0.0:
+                normals.append(None)
+                continue
+            a, b, c = nx / length, ny / length, nz / length
+            normals.append((a, b, c))
+            p = points[tri[0]]
+            d = -(a * p[0] + b * p[1] + c * p[2])
+            w = length * 0.5
+            plane = (a * a * w, a * b * w, a * c * w, a * d * w, b * b * w, b * c * w, b * d * w, c * c * w, c * d * w, d * d * w)
+            for v in tri:
+                q = quadrics[v]
+                for i in xrange(0, 10):
+                    q[i] += plane[i]
+        def cost(q, r, p):
+            x, y, z = p
+            q = [ q[i] + r[i] for i in xrange(0, 10) ]
+            return (q[0] * x * x + 2 * q[1] * x * y + 2 * q[2] * x * z + 2 * q[3] * x +
+                    q[4] * y * y + 2 * q[5] * y * z + 2 * q[6] * y +
+                    q[7] * z * z + 2 * q[8] * z + q[9])
+        # candidate collapses, u onto v; an entry is stale once either
+        # end has changed since
+        stamps = [ 0 ] * nverts
+        heap = []
+        def push(u, v):
+            if not locked[u]:
+                heap.append((cost(quadrics[u], quadrics[v], points[v]), u, v, stamps[u], stamps[v]))
+        for a, b in edges.keys():
+            push(a, b)
+            push(b, a)
+        heapq.heapify(heap)
+        def neighbours(v):
+            around = set()
+            for t in vtris[v]:
+                around.update(tris[t])
+            around.discard(v)
+            return around
+        dead = [ False ] * ntris
+        alive = ntris
+        levels = []
+        for target in targets:
+            while alive > target and heap:
+                c, u, v, su, sv = heapq.heappop(heap)
+                if stamps[u] != su or stamps[v] != sv or not vtris[u] or not vtris[v]:
+                    continue
+                shared = vtris[u] & vtris[v]
+                if not shared:
+                    continue
+                # the ends may only share the neighbours across the edge
+                if len(neighbours(u) & neighbours(v)) != len(shared):
+                    continue
+                # no triangle may turn more than 60 degrees from how it was,
+                # or from how it began
+                folds = False
+                for t in vtris[u] - shared:
+                    corners = [ points[w] for w in tris[t] ]
+                    before = normal(corners[0], corners[1], corners[2])
+                    corners[tris[t].index(u)] = points[v]
+                    after = normal(corners[0], corners[1], corners[2])
+                    length = math.sqrt(after[0] * after[0] + after[1] * after[1] + after[2] * after[2])
+                    if length == 0.0:
+                        folds = True
+                        break
+                    after = (after[0] / length, after[1] / length, after[2] / length)
+                    length = math.sqrt(before[0] * before[0] + before[1] * before[1] + before[2] * before[2])
+                    if length > 0.0 and (before[0] * after[0] + before[1] * after[1] + before[2] * after[2]) / length < 0.5:
+                        folds = True
+                        break
+                    first = normals[t]
+                    if first is not None and first[0] * after[0] + first[1] * after[1] + first[2] * after[2] < 0.5:
+                        folds = True
+                        break
+                if folds:
+                    continue
+                for t in shared:
+                    for w in tris[t]:
+                        vtris[w].discard(t)
+                    dead[t] = True
+                    alive -= 1
+                for t in vtris[u]:
+                    tris[t][tris[t].index(u)] = v
+                    vtris[v].add(t)
+                vtris[u] = set()
+                q, r = quadrics[v], quadrics[u]
+                for i in xrange(0, 10):
+                    q[i] += r[i]
+                stamps[v] += 1
+                for w in neighbours(v):
+                    if not locked[w]:
+                        heapq.heappush(heap, (cost(quadrics[w], q, points[v]), w, v, stamps[w], stamps[v]))
+                    if not locked[v]:
+                        heapq.heappush(heap, (cost(q, quadrics[w], points[w]), v, w, stamps[v], stamps[w]))
+            # a compacted copy, with the batches (empty or not) in place
+            level = TriMesh(self.name)
+            if self.uvs is not None:
+                level.uvs = array.array("f")
+            if self.normals is not None:
+                level.normals = array.array("f")
+            if self.tangents is not None:
+                level.tangents = array.array("f")
+                level.binormals = array.array("f")
+            remap = {}
+            for name, first, count in self.batches:
+                start = level.getNumTriangles()
+                for t in xrange(first, first + count):
+                    if dead[t]:
+                        continue
+                    for v in tris[t]:
+                        i = remap.get(v)
+                        if i is None:
+                            i = remap[v] = level.appendVertex(self, v)
+                        level.triangles.append(i)
+                    level.facenums.append(self.facenums[t])
+                level.batches.append((name, start, level.getNumTriangles() - start))
+            levels.append(level)
+        return levels
+
+    def appendVertex(self, mesh, v):
+        """append a copy of vertex v of another mesh (with the same
+        vertex format), return the copy's index"""
+        i = len(self.sources)
+        self.sources.append(mesh.sources[v])
+        self.positions.extend(mesh.positions[v * 3:v * 3 + 3])
+        if self.uvs is not None:
+            self.uvs.extend(mesh.uvs[v * 2:v * 2 + 2])
+        if self.normals is not None:
+            self.normals.extend(mesh.normals[v * 3:v * 3 + 3])
+        if self.tangents is not None:
+            self.tangents.extend(mesh.tangents[v * 3:v * 3 + 3])
+            self.binormals.extend(mesh.binormals[v * 3:v * 3 + 3])
+        return i
+
+    def duplicateVertex(self, v):
+        """append a copy of vertex v, return the copy's index"""
+        i = len(self.sources)
+        self.sources.append(self.sources[v])
+        self.positions.extend(self.positions[v * 3:v * 3 + 3])
+        if self.uvs is not None:
+            self.uvs.extend(self.uvs[v * 2:v * 2 + 2])
+        if self.normals is not None:
+            self.normals.extend(self.normals[v * 3:v * 3 + 3])
+        return i
+
+    def toEggVertices(self, evpool):
+        """add the vertices to an EggVertexPool, return the EggVertex list"""
+        evs = []
+        positions = self.positions
+        uvs = self.uvs
+        normals = self.normals
+        tangents = self.tangents
+        binormals = self.binormals
+        for i in xrange(0, len(self.sources)):
+            p = i * 3
+            ev = EggVertex()
+            ev.setPos(Point3D(positions[p], positions[p + 1], positions[p + 2]))
+            if tangents is not None:
+                evuv = EggVertexUV("", Point2D(uvs[i * 2], uvs[i * 2 + 1]))
+                evuv.setTangent(Vec3D(tangents[p], tangents[p + 1], tangents[p + 2]))
+                evuv.setBinormal(Vec3D(binormals[p], binormals[p + 1], binormals[p + 2]))
+                ev.setUvObj(evuv)
+            elif uvs is not None:
+                ev.setUv(Point2D(uvs[i * 2], uvs[i * 2 + 1]))
+            if normals is not None:
+                ev.setNormal(Vec3D(normals[p], normals[p + 1], normals[p + 2]))
+            evpool.addVertex(ev)
+            evs.append(ev)
+        return evs
+
+
+class TDSChunk(object):
     CHUNK_ATTRIB = {}
     # if "container" is True, then try to subdivide the chunk.
     # "name" is a printable name for the id.
@@ -45,21 +886,23 @@ class TDSChunk:
     # a few of the eggifygeometry() methods in various chunks...
     # generally, leaf chunks push relevant data up into their
     # parent's attribute dict.
+    # chunks marked "skip" hold nothing the conversion passes use, so
+    # the passes never visit them and their subtrees are never built.
     CHUNK_ATTRIB[0x4d4d] = { "container":  True, "name": "root" }
     CHUNK_ATTRIB[0x0002] = { "container": False, "name": "version" }
     CHUNK_ATTRIB[0x0010] = { "container": False, "name": "colorf" }
     CHUNK_ATTRIB[0x0011] = { "container": False, "name": "color24" }
     CHUNK_ATTRIB[0x0030] = { "container": False, "name": "percentage" }
     CHUNK_ATTRIB[0x0100] = { "container": False, "name": "scale" }
-    CHUNK_ATTRIB[0x1200] = { "container":  True, "name": "solidbackground" }
-    CHUNK_ATTRIB[0x1201] = { "container":  True, "name": "usesolidbackground" }
+    CHUNK_ATTRIB[0x1200] = { "container":  True, "name": "solidbackground", "skip": True }
+    CHUNK_ATTRIB[0x1201] = { "container":  True, "name": "usesolidbackground", "skip": True }
     CHUNK_ATTRIB[0x1300] = { "container": False, "name": "vgradient" }
     CHUNK_ATTRIB[0x1400] = { "container": False, "name": "loshadowbias" }
     CHUNK_ATTRIB[0x1410] = { "container": False, "name": "hishadowbias" }
     CHUNK_ATTRIB[0x1420] = { "container": False, "name": "shadowmapsize" }
     CHUNK_ATTRIB[0x1450] = { "container": False, "name": "shadowfilter" }
     CHUNK_ATTRIB[0x1460] = { "container": False, "name": "raybias" }
-    CHUNK_ATTRIB[0x2100] = { "container":  True, "name": "ambientlight" }
+    CHUNK_ATTRIB[0x2100] = { "container":  True, "name": "ambientlight", "skip": True }
     CHUNK_ATTRIB[0x2200] = { "container": False, "name": "fog" }
     CHUNK_ATTRIB[0x2300] = { "container": False, "name": "distancecue" }
     CHUNK_ATTRIB[0x2302] = { "container": False, "name": "layerfog" }
@@ -76,7 +919,7 @@ class TDSChunk:
     CHUNK_ATTRIB[0x4160] = { "container": False, "name": "meshmatrix" }
     CHUNK_ATTRIB[0x4165] = { "container": False, "name": "meshcolor" }
     CHUNK_ATTRIB[0x4700] = { "container": False, "name": "camera" }
-    CHUNK_ATTRIB[0x8000] = { "container":  True, "name": "xdata" }
+    CHUNK_ATTRIB[0x8000] = { "container":  True, "name": "xdata", "skip": True }
     CHUNK_ATTRIB[0x8001] = { "container": False, "name": "xdataentry" }
     CHUNK_ATTRIB[0xa000] = { "container": False, "name": "materialname" }
     CHUNK_ATTRIB[0xa010] = { "container":  True, "name": "ambient" }
@@ -93,12 +936,12 @@ class TDSChunk:
     CHUNK_ATTRIB[0xa08a] = { "container":  True, "name": "xpfallin" }
     CHUNK_ATTRIB[0xa100] = { "container":  True, "name": "shading" }
     CHUNK_ATTRIB[0xa200] = { "container":  True, "name": "texturemap" }
-    CHUNK_ATTRIB[0xa220] = { "container":  True, "name": "reflectionmap" }
+    CHUNK_ATTRIB[0xa220] = { "container":  True, "name": "reflectionmap", "skip": True }
     CHUNK_ATTRIB[0xa300] = { "container": False, "name": "mapname" }
     CHUNK_ATTRIB[0xa351] = { "container":  True, "name": "maptiling" }
     CHUNK_ATTRIB[0xa353] = { "container":  True, "name": "maptexblur" }
     CHUNK_ATTRIB[0xafff] = { "container":  True, "name": "material" }
-    CHUNK_ATTRIB[0xb000] = { "container":  True, "name": "keyf3ds" }
+    CHUNK_ATTRIB[0xb000] = { "container":  True, "name": "keyf3ds", "skip": True }
     CHUNK_ATTRIB[0xb002] = { "container":  True, "name": "objectnodetag" }
     CHUNK_ATTRIB[0xb008] = { "container": False, "name": "kfseg" }
     CHUNK_ATTRIB[0xb009] = { "container": False, "name": "kftime" }
@@ -112,6 +955,22 @@ class TDSChunk:
     CHUNK_ATTRIB[0xb022] = { "container": False, "name": "trackscl" }
     CHUNK_ATTRIB[0xb030] = { "container": False, "name": "nodeid" }
 
+    # flat lookup tables made from CHUNK_ATTRIB by initChunkMakers(),
+    # so that dispatch is a single dict lookup per chunk id
+    CHUNK_CONTAINER = {}
+    CHUNK_NAME = {}
+    CHUNK_MAKER = {}
+    CHUNK_SKIP = {}
+
+    # what get() returns for keys that were never put; subclasses
+    # override this rather than putting defaults into every instance
+    ATTRIB_DEFAULTS = {}
+
+    # there can be tens of thousands of chunks, most of them leaves
+    # that only ever push their data up to the parent; slots keep them
+    # small, and attrib is only made for chunks that put something.
+    __slots__ = ("parent", "child", "id", "base", "limit", "data", "attrib", "expanded")
+
     def __init__(self, parent=None):
         self.parent = parent
         self.child = []
@@ -119,31 +978,32 @@ class TDSChunk:
         self.base = 0
         self.limit = 0
         self.data = None
-        self.attrib = {}
+        self.attrib = None
+        self.expanded = False
 
     def put(self, key, value):
+        if self.attrib is None:
+            self.attrib = {}
         self.attrib[key] = value
         return self
 
     def get(self, key):
-        if self.attrib.has_key(key):
-            return self.attrib[key]
-        return None
+        attrib = self.attrib
+        if attrib is not None and key in attrib:
+            return attrib[key]
+        return self.ATTRIB_DEFAULTS.get(key)
 
     def has_key(self, key):
-        return self.attrib.has_key(key)
+        return self.attrib is not None and key in self.attrib
 
     def isContainer(self, id):
-        if TDSChunk.CHUNK_ATTRIB.has_key(id):
-            attr = TDSChunk.CHUNK_ATTRIB[id]
-            return attr["container"]
-        return False
+        return TDSChunk.CHUNK_CONTAINER.get(id, False)
 
     def getchunknamebyid(self, id):
-        if TDSChunk.CHUNK_ATTRIB.has_key(id):
-            attr = TDSChunk.CHUNK_ATTRIB[id]
-            return attr["name"]
-        return "UNKNOWN_%04x" % id
+        name = TDSChunk.CHUNK_NAME.get(id)
+        if name is None:
+            return "UNKNOWN_%04x" % id
+        return name
 
     def addChild(self, child):
         """add a child chunk to this chunk"""
@@ -157,87 +1017,194 @@ class TDSChunk:
 
     def chunkmaker(self, parentchunk, id):
         """make a chunk, perhaps specialized, by .3ds chunk id"""
-        maker = None
-        if TDSChunk.CHUNK_ATTRIB.has_key(id) and TDSChunk.CHUNK_ATTRIB[id].has_key("make"):
-            maker = TDSChunk.CHUNK_ATTRIB[id]["make"]
-        if maker is None:
-            maker = TDSChunk
-        child = maker(parentchunk)
+        child = TDSChunk.CHUNK_MAKER.get(id, TDSChunk)(parentchunk)
         child.id = id
         return child
 
-    def subdivide(self, depth, parentchunk, data, verbose=True):
-        """subdivide a chunk, provided its marked as a container"""
-        if not self.isContainer(self.id):
-            return self
-        base = self.subchunkbase(data)
-        limit = self.limit
-        if (limit - base) < 6:
+    def iterheaders(self, data=None):
+        """yield (base, id, length) for each subchunk header, without
+        making any chunk objects"""
+        if data is None:
+            data = self.data
+        return chunkheaders(data, self.subchunkbase(data), self.limit)
+
+    def subdivide(self, depth, parentchunk, data, verbose=False):
+        """enumerate the immediate subchunks of a chunk, provided its
+        marked as a container. the children are not subdivided here;
+        that happens when a traversal first asks for their children."""
+        self.expanded = True
+        if not TDSChunk.CHUNK_CONTAINER.get(self.id, False):
             return self
-        while base < limit:
-            id, length = struct.unpack("<HI", data[base:base + 6])
-            child = self.chunkmaker(self, id)
-            child.base = base
-            child.limit = child.base + length
+        makers = TDSChunk.CHUNK_MAKER
+        children = self.child
+        for base, id, length in self.iterheaders(data):
             if verbose:
-                print "    " * depth, "%6d 0x%04x %6d [%s]" % (base, id, length, self.getchunknamebyid(id))
-            self.addChild(child)
-            child.subdivide(depth + 1, self, data)
-            base = child.limit
+                chunklog.debug("%s%6d 0x%04x %6d [%s]", "    " * depth, base, id, length, self.getchunknamebyid(id))
+            maker = makers.get(id)
+            if maker is None:
+                # nothing can use an unknown chunk, so skip it by length
+                continue
+            child = maker(self)
+            child.id = id
+            child.base = base
+            child.limit = base + length
+            child.data = data
+            children.append(child)
         return self
 
+    def dumplines(self, depth=0):
+        """generate the lines of the chunk tree below this chunk
+        (expanding all of it)"""
+        if not self.isContainer(self.id):
+            return
+        children = iter(self.getchildren())
+        for base, id, length in self.iterheaders():
+            yield "%s%6d 0x%04x %6d [%s]" % ("    " * depth, base, id, length, self.getchunknamebyid(id))
+            if self.isKnownChunkID(id):
+                for line in children.next().dumplines(depth + 1):
+                    yield line
+
     def isKnownChunkID(self, id=None):
         if id is None: id = self.id
-        return TDSChunk.CHUNK_ATTRIB.has_key(id)
+        return id in TDSChunk.CHUNK_NAME
 
     def getchildren(self):
+        if not self.expanded:
+            self.subdivide(0, self.parent, self.data)
         return self.child
 
+    def getpasschildren(self):
+        """the children the conversion passes need to visit"""
+        skip = TDSChunk.CHUNK_SKIP
+        return [ chunk for chunk in self.getchildren() if chunk.id not in skip ]
+
+    def traverse(self, passname, rootchunk, egg):
+        """run a pass (a method name) over the children of this chunk"""
+        profiler = rootchunk.profiler
+        if profiler is None:
+            for chunk in self.getpasschildren():
+                getattr(chunk, passname)(rootchunk, egg)
+            return self
+        if not self.expanded:
+            profiler.beginphase("subdivide")
+            self.getchildren()
+            profiler.endphase("subdivide")
+        for chunk in self.getpasschildren():
+            profiler.enterchunk(passname, chunk)
+            getattr(chunk, passname)(rootchunk, egg)
+            profiler.leavechunk(passname, chunk)
+        return self
+
     def eggifyinit(self, rootchunk, egg):
         """initialization pass"""
-        for chunk in self.getchildren():
-            chunk.eggifyinit(rootchunk, egg)
-        return self
+        return self.traverse("eggifyinit", rootchunk, egg)
 
     def eggifymaterials(self, rootchunk, egg):
         """traverse and convert materials"""
-        for chunk in self.getchildren():
-            chunk.eggifymaterials(rootchunk, egg)
-        return self
+        return self.traverse("eggifymaterials", rootchunk, egg)
 
     def eggifygeometry(self, rootchunk, egg):
         """traverse and convert geometry"""
-        for chunk in self.getchildren():
-            chunk.eggifygeometry(rootchunk, egg)
-        return self
+        return self.traverse("eggifygeometry", rootchunk, egg)
+
+class ChunkTreeDump:
+    """a chunk tree as a log message argument: nothing is expanded or
+    formatted unless the message actually gets emitted"""
+    __slots__ = ("chunk", "depth")
+    def __init__(self, chunk, depth=0):
+        self.chunk = chunk
+        self.depth = depth
+
+    def __str__(self):
+        return "\n".join(self.chunk.dumplines(self.depth))
+
 
 # important chunks are specialized
 class ChunkRoot(TDSChunk):
     """the root chunk of a .3ds file"""
+    __slots__ = ("materialsbyname", "materials", "materialsbykey", "texturesbypath", "profiler")
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
         self.materialsbyname = {}
-
-    def load(self, fileobj, offset, verbose=True):
-        """read in the entire .3ds file (ie, the root chunk)"""
+        self.materials = []
+        # content key -> material chunk, and texture path -> the
+        # material chunk whose texture the others share
+        self.materialsbykey = {}
+        self.texturesbypath = {}
+        self.profiler = None
+
+    def load(self, fileobj, offset, verbose=True, usemmap=False):
+        """read in the entire .3ds file (ie, the root chunk)
+
+        with usemmap, the file is mapped rather than read, and every
+        chunk offset is an offset into that one shared mapping."""
         fileobj.seek(offset)
         header = fileobj.read(6)
         id, length = struct.unpack("<HI", header)
         self.id = id
         self.base = offset
         self.limit = self.base + length
-        self.data = header + fileobj.read(length - 6)
+        if usemmap:
+            self.data = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = header + fileobj.read(length - 6)
+        if verbose:
+            chunklog.debug("%6d 0x%04x %6d [%s]", self.base, id, length, self.getchunknamebyid(id))
+        return self
+
+    def loadData(self, data, verbose=True):
+        """use a .3ds file that is already in memory as the root chunk"""
+        id, length = struct.unpack_from("<HI", data, 0)
+        self.id = id
+        self.base = 0
+        self.limit = length
+        self.data = data
         if verbose:
-            print "%6d 0x%04x %6d [%s]" % (self.base, id, length, self.getchunknamebyid(id))
+            chunklog.debug("%6d 0x%04x %6d [%s]", self.base, id, length, self.getchunknamebyid(id))
+        return self
+
+    def unload(self):
+        """release the file data (and the mapping, if there is one)"""
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = None
         return self
 
     def addMaterial(self, matchunk):
-        """an easy (not the best) place to note a material chunk"""
+        """an easy (not the best) place to note a material chunk.
+
+        with "dedupmaterials" on, a material with the same content as
+        an earlier one is not kept: its name just refers to the earlier
+        chunk. materials with the same texture map share one texture,
+        and with a "materiallibrary" the names come from the library."""
         name = matchunk.getName()
         # print "ChunkRoot:", name, matchunk
-        self.materialsbyname[name] = matchunk
+        canonical = matchunk
+        if self.get("dedupmaterials"):
+            key = matchunk.getContentKey()
+            canonical = self.materialsbykey.setdefault(key, matchunk)
+            if canonical is matchunk:
+                library = self.get("materiallibrary")
+                if library is not None:
+                    matchunk.put("name", library.getMaterialName(key, name))
+                path = matchunk.get("texturepath")
+                if path is not None:
+                    owner = self.texturesbypath.setdefault(path, matchunk)
+                    if owner is not matchunk:
+                        matchunk.textureowner = owner
+                    elif library is not None:
+                        matchunk.put("texturename", library.getTextureName(path, matchunk.getTextureName()))
+        self.materialsbyname[name] = canonical
+        if canonical is matchunk:
+            self.materials.append(matchunk)
         return self
 
+    def getMaterials(self):
+        """the material chunks in file order, one per name"""
+        named = dict([ (id(mtl), True) for mtl in self.materialsbyname.values() ])
+        return [ mtl for mtl in self.materials if named.has_key(id(mtl)) ]
+
     def getMaterial(self, name):
         """return a material chunk given a name"""
         if self.materialsbyname.has_key(name):
@@ -246,7 +1213,13 @@ class ChunkRoot(TDSChunk):
 
     def eggifygeometry(self, rootchunk, egg):
         """start making an .egg before recursing"""
-        print "ChunkRoot:", "egg:", egg
+        writer = self.get("writer")
+        if writer is not None:
+            writer.beginGroup("<Group>", self.get("name"))
+            TDSChunk.eggifygeometry(self, rootchunk, egg)
+            writer.endGroup()
+            return self
+        log.debug("ChunkRoot: egg: %s", egg)
         eobj = EggGroup(self.get("name"))
         egg.addChild(eobj)
         TDSChunk.eggifygeometry(self, rootchunk, eobj)
@@ -254,6 +1227,8 @@ class ChunkRoot(TDSChunk):
 
 
 class ChunkNamedObject(TDSChunk):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
 
@@ -261,18 +1236,18 @@ class ChunkNamedObject(TDSChunk):
         """return the next potential subchunk offset"""
         # chunk ID 0x4000 ("namedobject") has an asciz up front
         # that must be stepped over.
-        base = self.base + 6
-        name_start = base
-        c = data[base:base+1]
-        while ord(c) is not 0:
-            base += 1
-            c = data[base:base+1]
-        name_end = base
-        self.put("name", data[name_start:name_end])
-        return base + 1
+        name, base = readasciz(data, self.base + 6)
+        self.put("name", name)
+        return base
 
     def eggifygeometry(self, rootchunk, egg):
         self.put("triobjects", [])
+        writer = rootchunk.get("writer")
+        if writer is not None:
+            writer.beginGroup("<Group>", self.get("name"))
+            TDSChunk.eggifygeometry(self, rootchunk, egg)
+            writer.endGroup()
+            return self
         egrp = EggGroup(self.get("name"))
         egg.addChild(egrp)
         TDSChunk.eggifygeometry(self, rootchunk, egrp)
@@ -280,21 +1255,36 @@ class ChunkNamedObject(TDSChunk):
         return self
 
 class ChunkTriObject(TDSChunk):
+    __slots__ = ("matnamebyface",)
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
-        self.matnamebyface = {}
+        self.matnamebyface = None
         self.put("faces", [])
         self.put("points", [])
         self.put("uvs", [])
+        self.put("facearray", array.array("H"))
+        self.put("pointarray", array.array("f"))
+        self.put("uvarray", array.array("f"))
+        self.put("matgroups", [])
+        self.put("smoothing", None)
 
     def setMatNameByFace(self, facenum, matname):
-        self.matnamebyface[facenum] = matname
+        self.getMatNamesByFace()[facenum] = matname
         return self
 
+    def getMatNamesByFace(self):
+        """a facenum -> material name dict, made from the matgroups"""
+        if self.matnamebyface is None:
+            self.matnamebyface = {}
+            for mgrp in self.get("matgroups"):
+                mname = mgrp.get("name")
+                for facenum in mgrp.get("faces"):
+                    self.matnamebyface[facenum] = mname
+        return self.matnamebyface
+
     def getMatNameByFace(self, facenum):
-        if self.matnamebyface.has_key(facenum):
-            return self.matnamebyface[facenum]
-        return None
+        return self.getMatNamesByFace().get(facenum)
 
     def getMaterialByFace(self, rootchunk, facenum):
         matname = self.getMatNameByFace(facenum)
@@ -302,102 +1292,296 @@ class ChunkTriObject(TDSChunk):
             return rootchunk.getMaterial(matname)
         return None
 
-    def __eggifypoly(self, egg, eprim, evpool, rootchunk, facenum, vlist, points, uvs, mtl):
-        # configure some defaults, then adjust them
-        if len(uvs) == 0:
-            hasuvs = False
-        else:
-            hasuvs = True
-        eprim2 = None
+    def getMaterialBatches(self, rootchunk=None):
+        """group the faces by material, once, using the meshmatgroup
+        face lists. returns (facenums, batches), where facenums lists
+        the faces batch by batch, and batches holds a (material name,
+        first, count) range of facenums per material. faces in no
+        group come last, under a material name of None.
+
+        given the root chunk, names that refer to the same (deduped)
+        material share one batch, under the first of the names."""
+        nfaces = len(self.get("facearray")) // 4
+        names = []
+        slotbyname = {}
+        # as with a dict keyed on face, a later group wins a face
+        faceslot = array.array("i", [-1]) * nfaces
+        for mgrp in self.get("matgroups"):
+            name = mgrp.get("name")
+            key = name
+            if rootchunk is not None:
+                mtl = rootchunk.getMaterial(name)
+                if mtl is not None:
+                    key = mtl
+            slot = slotbyname.get(key)
+            if slot is None:
+                slot = len(names)
+                slotbyname[key] = slot
+                names.append(name)
+            for f in mgrp.get("faces"):
+                if f < nfaces:
+                    faceslot[f] = slot
+        names.append(None)
+        buckets = [ array.array("I") for name in names ]
+        for f in xrange(0, nfaces):
+            buckets[faceslot[f]].append(f)
+        facenums = array.array("I")
+        batches = []
+        for name, bucket in zip(names, buckets):
+            if len(bucket) > 0:
+                batches.append((name, len(facenums), len(bucket)))
+                facenums.extend(bucket)
+        return facenums, batches
+
+    def __eggifybatch(self, egg, evs, mesh, first, count, mtl):
+        # the state is worked out once for the whole batch
+        texture = None
+        material = None
+        color = None
+        twosided = False
         if mtl is not None:
-            if mtl.isTwoSided():
-                eprim2 = EggPolygon()
-                egg.addChild(eprim2)
+            twosided = mtl.isTwoSided()
             if mtl.isTextured():
-                eprim.setTexture(mtl.getEggTexture())
-                eprim.setMaterial(mtl.getEggMaterial())
-                if eprim2 is not None:
-                    eprim2.setTexture(mtl.getEggTexture())
-                    eprim2.setMaterial(mtl.getEggMaterial())
+                texture = mtl.getEggTexture()
+                material = mtl.getEggMaterial()
             rgb = mtl.get("diffuse")
             if rgb is not None:
-                eprim.setColor(Vec4(rgb[0], rgb[1], rgb[2], 1.0))
-                if eprim2 is not None:
-                    eprim2.setColor(Vec4(rgb[0], rgb[1], rgb[2], 1.0))
-                if False:
-                    eprim.setMaterial(mtl.getEggMaterial())
-                    if eprim2 is not None:
-                        eprim2.setMaterial(mtl.getEggMaterial())
-        evobjs = []
-        for v in vlist[0:3]:
-            xyz = points[v]
-            ev = EggVertex()
-            ev.setPos(Point3D(xyz[0], xyz[1], xyz[2]))
-            if hasuvs:
-                uv = uvs[v]
-                ev.setUv(Point2D(uv[0], uv[1]))
-            evpool.addVertex(ev)
-            eprim.addVertex(ev)
-            evobjs.insert(0, ev)
-        if eprim2 is not None:
-            for ev in evobjs:
-                eprim2.addVertex(ev)
+                color = Vec4(rgb[0], rgb[1], rgb[2], 1.0)
+        triangles = mesh.triangles
+        for t in xrange(first, first + count):
+            eprim = EggPolygon()
+            egg.addChild(eprim)
+            if texture is not None:
+                eprim.setTexture(texture)
+                eprim.setMaterial(material)
+            if color is not None:
+                eprim.setColor(color)
+            if twosided:
+                eprim.setBfaceFlag(True)
+            i = t * 3
+            eprim.addVertex(evs[triangles[i]])
+            eprim.addVertex(evs[triangles[i + 1]])
+            eprim.addVertex(evs[triangles[i + 2]])
         return self
 
+    def getTriMesh(self, rootchunk):
+        """the welded, material-batched mesh for this object (its
+        children must have been through eggifygeometry already)"""
+        mesh = TriMesh(self.parent.get("name"))
+        weld = rootchunk.get("weld")
+        if weld is None:
+            weld = True
+        facenums, batches = self.getMaterialBatches(rootchunk)
+        cornernormals = None
+        # tangents are built against the smoothing group normals
+        tangents = rootchunk.get("tangents") and len(self.get("uvarray")) > 0
+        if rootchunk.get("smoothnormals") or tangents:
+            cornernormals = smoothnormals(self.get("pointarray"), self.get("facearray"), self.get("smoothing"))
+        mesh.weld(self.get("pointarray"), self.get("uvarray"), self.get("facearray"),
+                  weld, rootchunk.get("weldepsilon"), facenums, cornernormals)
+        mesh.batches = batches
+        if tangents:
+            mesh.computeTangents()
+        distances = rootchunk.get("loddistances")
+        if distances:
+            ratio = rootchunk.get("lodratio")
+            targets = [ int(mesh.getNumTriangles() * ratio ** k) for k in xrange(1, len(distances)) ]
+            mesh.levels = []
+            for level in mesh.decimate(targets, self.get("smoothing")):
+                if level.getNumTriangles() >= ([ mesh ] + mesh.levels)[-1].getNumTriangles():
+                    # no collapse was left to make; the last level is
+                    # seen out to the last distance instead
+                    break
+                mesh.levels.append(level)
+        if rootchunk.get("vertexcache"):
+            mesh.optimizeVertexCache()
+            for level in mesh.levels or ():
+                level.optimizeVertexCache()
+        return mesh
+
+    def getBatchMaterials(self, rootchunk, mesh):
+        """the material chunk (or None) of each of the mesh's batches"""
+        mtls = []
+        for name, first, count in mesh.batches:
+            if name is None:
+                mtls.append(None)
+            else:
+                mtls.append(rootchunk.getMaterial(name))
+        return mtls
+
     def eggifygeometry(self, rootchunk, egg):
-        TDSChunk.eggifygeometry(self, rootchunk, egg)
+        # the mesh may have been made already, on another process
+        mesh = None
+        premade = rootchunk.get("premade")
+        if premade is not None:
+            mesh = premade.getTriMesh(self)
+        decoded = mesh is None
+        if decoded:
+            TDSChunk.eggifygeometry(self, rootchunk, egg)
         self.parent.get("triobjects").append(self)
         # we should now have everything we need to know...
         name = self.parent.get("name")
-        points = self.get("points")
-        uvs = self.get("uvs")
-        faces  = self.get("faces")
-        evpool = EggVertexPool(name)
-        egg.addChild(evpool)
-        facenum = 0
-        for face in faces:
-            epoly = EggPolygon()
-            egg.addChild(epoly)
-            mtl = self.getMaterialByFace(rootchunk, facenum)
-            self.__eggifypoly(egg, epoly, evpool, rootchunk, facenum, face, points, uvs, mtl)
-            facenum += 1
-        print "object \"%s\": %d tris, %d vertices, %d uvs" % (name, len(faces), len(points), len(uvs))
+        instances = rootchunk.get("instances")
+        if instances is not None:
+            digest, prototype, matrix = instances.match(self, rootchunk)
+            if prototype is not None:
+                return self.__eggifyinstance(rootchunk, egg, name, prototype, matrix)
+        if decoded:
+            mesh = self.getTriMesh(rootchunk)
+        mtls = self.getBatchMaterials(rootchunk, mesh)
+        if rootchunk.profiler is not None:
+            rootchunk.profiler.count("objects", 1)
+            rootchunk.profiler.count("triangles", mesh.getNumTriangles())
+            rootchunk.profiler.count("vertices", mesh.getNumVertices())
+            rootchunk.profiler.count("batches", len(mesh.batches))
+        if mesh.cachemisses is not None:
+            before, after = mesh.cachemisses
+            ntris = max(1, mesh.getNumTriangles())
+            log.info("object \"%s\": vertex cache ACMR %.3f -> %.3f", name, before / float(ntris), after / float(ntris))
+            if rootchunk.profiler is not None:
+                rootchunk.profiler.count("cachemissesbefore", before)
+                rootchunk.profiler.count("cachemissesafter", after)
+        if mesh.levels is not None:
+            log.info("object \"%s\": levels of detail of %s tris", name, ", ".join([ str(level.getNumTriangles()) for level in [ mesh ] + mesh.levels ]))
+        writer = rootchunk.get("writer")
+        if writer is not None and mesh.levels is not None:
+            self.__writelevels(rootchunk, writer, name, mesh, mtls)
+            log.info("object \"%s\": %d tris, %d welded vertices, %d materials", name, mesh.getNumTriangles(), mesh.getNumVertices(), len(mtls))
+            self.child = []
+            self.attrib = None
+            return self
+        if writer is not None:
+            writer.writeMesh(name, mesh, mtls)
+            if instances is not None:
+                instances.add(digest, self, rootchunk, mesh, mtls)
+            log.info("object \"%s\": %d tris, %d welded vertices, %d materials", name, mesh.getNumTriangles(), mesh.getNumVertices(), len(mtls))
+            # the object is on its way to the file; drop the decoded data
+            self.child = []
+            self.attrib = None
+            return self
+        if mesh.levels is not None:
+            self.__eggifylevels(rootchunk, egg, name, mesh, mtls)
+        else:
+            evpool = EggVertexPool(name)
+            egg.addChild(evpool)
+            evs = mesh.toEggVertices(evpool)
+            for batch, mtl in zip(mesh.batches, mtls):
+                matname, first, count = batch
+                self.__eggifybatch(egg, evs, mesh, first, count, mtl)
+        if instances is not None:
+            instances.add(digest, self, rootchunk, mesh, mtls, evs)
+        if decoded:
+            log.info("object \"%s\": %d tris, %d vertices, %d uvs, %d welded vertices, %d materials", name, mesh.getNumTriangles(), len(self.get("pointarray")) // 3, len(self.get("uvarray")) // 2, mesh.getNumVertices(), len(mtls))
+        else:
+            log.info("object \"%s\": %d tris, %d welded vertices, %d materials", name, mesh.getNumTriangles(), mesh.getNumVertices(), len(mtls))
+        return self
+
+    def getLevels(self, rootchunk, name, mesh):
+        """(group name, vertex pool name, mesh, near, far) for each of a
+        mesh's levels of detail, with the switch distances"""
+        distances = rootchunk.get("loddistances")
+        levels = []
+        near = 0.0
+        for k, level in enumerate([ mesh ] + mesh.levels):
+            if k == len(mesh.levels):
+                far = distances[-1]
+            else:
+                far = distances[k]
+            if k == 0:
+                pool = name
+            else:
+                pool = "%s_lod%d" % (name, k)
+            levels.append(("%s_lod%d" % (name, k), pool, level, near, far))
+            near = far
+        return levels
+
+    def __writelevels(self, rootchunk, writer, name, mesh, mtls):
+        center = mesh.getCenter()
+        for group, pool, level, near, far in self.getLevels(rootchunk, name, mesh):
+            writer.writeLevel(group, pool, level, mtls, near, far, center)
+        return self
+
+    def __eggifylevels(self, rootchunk, egg, name, mesh, mtls):
+        # a group per level, each with the distances it is seen at;
+        # the object's group becomes an LOD node when it is loaded
+        center = mesh.getCenter()
+        for group, pool, level, near, far in self.getLevels(rootchunk, name, mesh):
+            egrp = EggGroup(group)
+            egrp.setLodAttribute(EggSwitchConditionDistance(far, near, Point3D(center[0], center[1], center[2])))
+            egg.addChild(egrp)
+            evpool = EggVertexPool(pool)
+            egrp.addChild(evpool)
+            evs = level.toEggVertices(evpool)
+            for batch, mtl in zip(level.batches, mtls):
+                matname, first, count = batch
+                self.__eggifybatch(egrp, evs, level, first, count, mtl)
+        return self
+
+    def __eggifyinstance(self, rootchunk, egg, name, prototype, matrix):
+        """refer to the mesh of an earlier object with the same
+        geometry, put through matrix, instead of making one"""
+        mesh = prototype["mesh"]
+        if rootchunk.profiler is not None:
+            rootchunk.profiler.count("objects", 1)
+            rootchunk.profiler.count("instances", 1)
+        writer = rootchunk.get("writer")
+        if writer is not None:
+            writer.writeInstance(name, mesh, prototype["mtls"], matrix)
+            self.child = []
+            self.attrib = None
+        else:
+            # vertices under an <Instance> are in its own space, so the
+            # prototype's pool serves as it is
+            einst = EggGroup(name)
+            einst.setGroupType(EggGroup.GTInstance)
+            einst.setTransform3d(Mat4D(matrix[0], matrix[1], matrix[2], 0.0,
+                                       matrix[3], matrix[4], matrix[5], 0.0,
+                                       matrix[6], matrix[7], matrix[8], 0.0,
+                                       matrix[9], matrix[10], matrix[11], 1.0))
+            egg.addChild(einst)
+            for batch, mtl in zip(mesh.batches, prototype["mtls"]):
+                matname, first, count = batch
+                self.__eggifybatch(einst, prototype["evs"], mesh, first, count, mtl)
+        log.info("object \"%s\": an instance of \"%s\"", name, prototype["name"])
         return self
 
 
 class ChunkPoints(TDSChunk):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
 
     def eggifygeometry(self, rootchunk, egg):
         data = rootchunk.data
         base = self.base + 6
-        nverts = struct.unpack("<H", data[base:base+2])[0]
-        base += 2;
-        verts = []
-        for i in xrange(0, nverts):
-            verts.append(struct.unpack("<fff", data[base:base+12]))
-            base += 12
-        self.parent.put("points", verts)
+        nverts = struct.unpack_from("<H", data, base)[0]
+        base += 2
+        # one bulk decode; "points" is kept as a tuple view for old callers
+        verts = unpackarray("f", data, base, nverts * 3)
+        self.parent.put("pointarray", verts)
+        self.parent.put("points", TupleView(verts, 3))
         return self
 
 class ChunkUVs(TDSChunk):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
 
     def eggifygeometry(self, rootchunk, egg):
         data = rootchunk.data
         base = self.base + 6
-        nverts = struct.unpack("<H", data[base:base+2])[0]
-        base += 2;
-        verts = []
-        for i in xrange(0, nverts):
-            verts.append(struct.unpack("<ff", data[base:base+8]))
-            base += 8
-        self.parent.put("uvs", verts)
+        nverts = struct.unpack_from("<H", data, base)[0]
+        base += 2
+        verts = unpackarray("f", data, base, nverts * 2)
+        self.parent.put("uvarray", verts)
+        self.parent.put("uvs", TupleView(verts, 2))
         return self
 
 class ChunkFaces(TDSChunk):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
         self.put("faces", [])
@@ -409,119 +1593,128 @@ class ChunkFaces(TDSChunk):
         # chunk ID 0x4120 ("faces") is variable length with an unsigned
         # short at the front of the array.
         base = self.base + 6
-        nfaces = struct.unpack("<H", data[base:base+2])[0]
+        nfaces = struct.unpack_from("<H", data, base)[0]
         # 2 for the array length, 4 shorts per element of the array
         base += 2 + (nfaces * 8)
         return base
 
     def eggifygeometry(self, rootchunk, egg):
         TDSChunk.eggifygeometry(self, rootchunk, egg)
-        for mgrp in self.get("matgroups"):
-            mname = mgrp.get("name")
-            mfaces = mgrp.get("faces")
-            for facenum in mfaces:
-                self.parent.setMatNameByFace(facenum, mname)
+        # the material groups are sorted out once per object, in
+        # ChunkTriObject.getMaterialBatches
+        self.parent.put("matgroups", self.get("matgroups"))
+        for sgrp in self.get("smoothgroups"):
+            self.parent.put("smoothing", sgrp.get("faces"))
         data = rootchunk.data
         base = self.base + 6
-        nfaces = struct.unpack("<H", data[base:base+2])[0]
+        nfaces = struct.unpack_from("<H", data, base)[0]
         base += 2
-        faces = []
-        for i in xrange(0, nfaces):
-            # face: (v1, v2, v3, faceinfobits)
-            faces.append(struct.unpack("<HHHH", data[base:base+8]))
-            base += 8
+        # face: (v1, v2, v3, faceinfobits), 4 shorts per face
+        facearray = unpackarray("H", data, base, nfaces * 4)
+        faces = TupleView(facearray, 4)
         self.put("faces", faces)
+        self.parent.put("facearray", facearray)
         self.parent.put("faces", faces)
         return self
 
 class ChunkMeshMatrix(TDSChunk):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
 
     def eggifygeometry(self, rootchunk, egg):
         data = rootchunk.data
         base = self.base + 6
-        nitems = 12
-        matrix = []
-        for i in xrange(0, 12):
-            matrix.append(struct.unpack("<f", data[base:base+4])[0])
-            base += 4
+        matrix = list(struct.unpack_from("<12f", data, base))
         self.parent.put("meshmatrix", matrix)
         return self
 
 class ChunkMeshMatGroup(TDSChunk):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
 
     def eggifygeometry(self, rootchunk, egg):
         data = rootchunk.data
-        base = self.base + 6
-        name_start = base
-        c = data[base:base+1]
-        while ord(c) is not 0:
-            base += 1
-            c = data[base:base+1]
-        name = data[name_start:base]
-        base = base + 1
+        name, base = readasciz(data, self.base + 6)
         self.put("name", name)
-        nfaces = struct.unpack("<H", data[base:base+2])[0]
+        nfaces = struct.unpack_from("<H", data, base)[0]
         base += 2
-        faces = []
-        for i in xrange(0, nfaces):
-            faces.append(struct.unpack("<H", data[base:base+2])[0])
-            base += 2
+        faces = unpackarray("H", data, base, nfaces)
         self.put("faces", faces)
         self.parent.get("matgroups").append(self)
         return self
 
 class ChunkSmoothGroup(TDSChunk):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
 
     def eggifygeometry(self, rootchunk, egg):
         data = rootchunk.data
         base = self.base + 6
-        faces = []
-        while base < self.limit:
-            bits = struct.unpack("<I", data[base:base+4])[0]
-            base += 4
-            faces.append(bits)
-        # self.put("faces", faces)
+        # one 32 bit smoothing group mask per face
+        faces = unpackarray("I", data, base, (self.limit - base) // 4)
+        self.put("faces", faces)
         self.parent.get("smoothgroups").append(self)
         return self
 
 class ChunkMaterialName(TDSChunk):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
 
     def eggifymaterials(self, rootchunk, egg):
         data = rootchunk.data
-        name = data[self.base+6:self.limit-1]
+        name = readasciz(data, self.base + 6)[0]
         self.parent.put("name", name)
         return self
 
 class ChunkMaterial(TDSChunk):
+    __slots__ = ("eggmaterial", "eggdiffusetexture", "textureowner")
+    ATTRIB_DEFAULTS = { "twosided": False }
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
         self.eggmaterial = None
         self.eggdiffusetexture = None
-        self.put("name", None)
-        self.put("twosided", False)
+        # the material whose texture this one shares, if not its own
+        self.textureowner = None
 
     def eggifymaterials(self, rootchunk, egg):
         TDSChunk.eggifymaterials(self, rootchunk, egg)
-        terse = {}
-        if self.get("twosided"):
-            terse["twosided"] = True
-        if self.get("texturemap"):
-            terse["texturemap"] = self.get("texturemap")
-        print "material:", self.get("name"), terse
+        if log.isEnabledFor(logging.INFO):
+            terse = {}
+            if self.get("twosided"):
+                terse["twosided"] = True
+            if self.get("texturemap"):
+                terse["texturemap"] = self.get("texturemap")
+            log.info("material: %s %s", self.get("name"), terse)
         rootchunk.addMaterial(self)
+        if rootchunk.profiler is not None:
+            rootchunk.profiler.count("materials", 1)
         return self
 
     def getName(self):
         return self.get("name")
 
+    def getContentKey(self):
+        """what makes two materials the same, whatever their names"""
+        key = []
+        for name in ("diffuse", "ambient", "specular"):
+            rgb = self.get(name)
+            if rgb is not None:
+                rgb = tuple(rgb)
+            key.append(rgb)
+        key.append(self.get("shininess"))
+        key.append(bool(self.get("twosided")))
+        key.append(self.get("texturepath"))
+        return tuple(key)
+
     def getEggMaterial(self):
         if self.eggmaterial:
             return self.eggmaterial
@@ -539,6 +1732,14 @@ class ChunkMaterial(TDSChunk):
             self.eggmaterial = m
         return self.eggmaterial
 
+    def getTextureName(self):
+        if self.textureowner is not None:
+            return self.textureowner.getTextureName()
+        name = self.get("texturename")
+        if name is not None:
+            return name
+        return self.get("name") + "_diffuse"
+
     def isTextured(self):
         if self.get("texturemap") is not None:
             return True
@@ -548,12 +1749,14 @@ class ChunkMaterial(TDSChunk):
         return self.get("twosided")
 
     def getEggTexture(self):
+        if self.textureowner is not None:
+            return self.textureowner.getEggTexture()
         if self.eggdiffusetexture:
             return self.eggdiffusetexture
         if not self.isTextured():
             return None
         # incomplete for now (ignores flags found in the .3ds file)
-        m = EggTexture(self.get("name") + "_diffuse", self.get("texturemap"))
+        m = EggTexture(self.getTextureName(), self.get("texturemap"))
         m.setFormat(EggTexture.FRgb)
         m.setMagfilter(EggTexture.FTLinearMipmapLinear)
         m.setMinfilter(EggTexture.FTLinearMipmapLinear)
@@ -563,6 +1766,8 @@ class ChunkMaterial(TDSChunk):
         return self.eggdiffusetexture
 
 class ChunkColor24(TDSChunk):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
 
@@ -570,13 +1775,15 @@ class ChunkColor24(TDSChunk):
         # 3 unsigned chars after the header... push up to the parent
         data = rootchunk.data
         base = self.base + 6
-        rgb = struct.unpack("BBB", data[base:base+3])
+        rgb = struct.unpack_from("BBB", data, base)
         frgb = [float(rgb[0]) / 255.0, float(rgb[1]) / 255.0, float(rgb[2]) / 255.0]
         self.parent.put("_color", rgb)
         self.parent.put("color", frgb)
         return self
 
 class ChunkPercentage(TDSChunk):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
 
@@ -585,14 +1792,16 @@ class ChunkPercentage(TDSChunk):
         # push value to the parent.
         data = rootchunk.data
         base = self.base + 6
-        percentage = struct.unpack("H", data[base:base+2])[0]
+        percentage = struct.unpack_from("H", data, base)[0]
         self.parent.put("percentage", percentage)
         return self
 
 class ChunkAmbient(TDSChunk):
+    __slots__ = ()
+    ATTRIB_DEFAULTS = { "color": (0, 0, 0) }
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
-        self.put("color", (0, 0, 0))
 
     def eggifymaterials(self, rootchunk, egg):
         TDSChunk.eggifymaterials(self, rootchunk, egg)
@@ -600,9 +1809,11 @@ class ChunkAmbient(TDSChunk):
         return self
 
 class ChunkDiffuse(TDSChunk):
+    __slots__ = ()
+    ATTRIB_DEFAULTS = { "color": (0.5, 0.5, 0.5) }
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
-        self.put("color", (0.5, 0.5, 0.5))
 
     def eggifymaterials(self, rootchunk, egg):
         TDSChunk.eggifymaterials(self, rootchunk, egg)
@@ -610,9 +1821,11 @@ class ChunkDiffuse(TDSChunk):
         return self
 
 class ChunkSpecular(TDSChunk):
+    __slots__ = ()
+    ATTRIB_DEFAULTS = { "color": (0.0, 0.0, 0.0) }
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
-        self.put("color", (0.0, 0.0, 0.0))
 
     def eggifymaterials(self, rootchunk, egg):
         TDSChunk.eggifymaterials(self, rootchunk, egg)
@@ -620,9 +1833,11 @@ class ChunkSpecular(TDSChunk):
         return self
 
 class ChunkShininess(TDSChunk):
+    __slots__ = ()
+    ATTRIB_DEFAULTS = { "shininess": 0 }
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
-        self.put("shininess", 0)
 
     def eggifymaterials(self, rootchunk, egg):
         TDSChunk.eggifymaterials(self, rootchunk, egg)
@@ -630,9 +1845,11 @@ class ChunkShininess(TDSChunk):
         return self
 
 class ChunkTransparency(TDSChunk):
+    __slots__ = ()
+    ATTRIB_DEFAULTS = { "transparency": 0 }
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
-        self.put("transparency", 0)
 
     def eggifymaterials(self, rootchunk, egg):
         TDSChunk.eggifymaterials(self, rootchunk, egg)
@@ -640,36 +1857,41 @@ class ChunkTransparency(TDSChunk):
         return self
 
 class ChunkMapname(TDSChunk):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
-        self.put("mapname", None)
 
     def eggifymaterials(self, rootchunk, egg):
         TDSChunk.eggifymaterials(self, rootchunk, egg)
         data = rootchunk.data
-        base = self.base + 6
-        name_start = base
-        c = data[base:base+1]
-        while ord(c) is not 0:
-            base += 1
-            c = data[base:base+1]
-        name_end = base
-        mapname = data[name_start:name_end]
-        self.put("mapname", mapname)
+        mapname = readasciz(data, self.base + 6)[0]
         self.parent.put("mapname", mapname)
         return self
 
 class ChunkTexturemap(TDSChunk):
+    __slots__ = ()
+    ATTRIB_DEFAULTS = { "mapname": None }
+
     def __init__(self, parent=None):
         TDSChunk.__init__(self, parent)
-        self.put("mapname", None)
 
     def eggifymaterials(self, rootchunk, egg):
         TDSChunk.eggifymaterials(self, rootchunk, egg)
-        self.parent.put("texturemap", self.get("mapname"))
+        mapname = self.get("mapname")
+        resolver = rootchunk.get("textureresolver")
+        if resolver is not None and mapname is not None:
+            mapname = resolver.resolve(mapname, rootchunk.get("texturedir"))
+        self.parent.put("texturemap", mapname)
+        if mapname is not None:
+            # the map as it is named in the egg is relative to the .3ds
+            # file; what identifies it across files is its real path
+            self.parent.put("texturepath", os.path.realpath(os.path.join(rootchunk.get("texturedir"), mapname)))
         return self
 
 class ChunkTwoSided(TDSChunk):
+    __slots__ = ()
+
     def __init__(self, parent=None):
         """if present in the .3ds, this chunk means 2-sided tris"""
         TDSChunk.__init__(self, parent)
@@ -687,7 +1909,8 @@ class ChunkTwoSided(TDSChunk):
 
 # most chunks we care about are instances of specialized classes.
 # the route below registers the constructors in the CHUNK_ATTRIB
-# table and are used by "TDSChunk.chunkmaker()"
+# table, and then flattens that into the lookup tables used by
+# "TDSChunk.chunkmaker()" and "TDSChunk.subdivide()"
 def initChunkMakers():
     chunkmakers = [
         ( 0x4000, ChunkNamedObject ),
@@ -715,118 +1938,2048 @@ def initChunkMakers():
     for item in chunkmakers:
         id, cls = item
         TDSChunk.CHUNK_ATTRIB[id]["make"] = cls
+    for id, attr in TDSChunk.CHUNK_ATTRIB.items():
+        TDSChunk.CHUNK_CONTAINER[id] = attr["container"]
+        TDSChunk.CHUNK_NAME[id] = attr["name"]
+        TDSChunk.CHUNK_MAKER[id] = attr.get("make", TDSChunk)
+        if attr.get("skip"):
+            TDSChunk.CHUNK_SKIP[id] = True
 initChunkMakers()
 
 
+def eggname(name):
+    """a name as it must appear in egg syntax, quoted if need be"""
+    if name and re.match(r"^[A-Za-z0-9_.+\-:/]+$", name):
+        return name
+    return eggstring(name)
+
+def eggstring(s):
+    """an always-quoted egg string"""
+    if s is None:
+        s = ""
+    return '"' + s.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def eggfloats(values):
+    return " ".join([ "%g" % v for v in values ])
+
+
+class MeshCollector:
+    """a stand-in writer that just keeps each (name, mesh, mtls), and
+    each (name, mesh, mtls, matrix) instance of a mesh"""
+    def __init__(self):
+        self.meshes = []
+        self.instances = []
+
+    def beginGroup(self, tag, name=None):
+        return self
+
+    def endGroup(self):
+        return self
+
+    def writeMaterials(self, mtls):
+        return self
+
+    def writeMesh(self, name, mesh, mtls):
+        self.meshes.append((name, mesh, mtls))
+        return self
+
+    def writeInstance(self, name, mesh, mtls, matrix):
+        self.instances.append((name, mesh, mtls, matrix))
+        return self
+
+    def writeLevel(self, group, name, mesh, mtls, near, far, center):
+        # the full mesh has the others on its levels
+        if mesh.levels is not None:
+            self.writeMesh(name, mesh, mtls)
+        return self
+
+
+class ParallelMeshes:
+    """decodes, welds and smooths the triobjects of a file on a pool of
+    worker processes, and hands the meshes back in chunk order.
+
+    the workers are forked once the materials pass is done, so they
+    inherit the root chunk (and the file data with it, be it a string
+    or a mapping): only chunk offsets go out to them, and only
+    TriMeshes come back. a few objects per worker are kept in flight,
+    so the finished meshes waiting to be written stay bounded."""
+
+    # the root chunk, as the workers see it
+    root = None
+
+    def __init__(self, root, objects, jobs):
+        import multiprocessing
+        import collections
+        ParallelMeshes.root = root
+        self.pool = multiprocessing.Pool(jobs, ParallelMeshes.initworker)
+        self.objects = list(objects)
+        self.window = jobs * 2
+        self.pending = collections.deque()
+        self.next = 0
+        # triobject base -> TriMesh, for the objects come back so far
+        self.meshes = {}
+
+    def initworker():
+        # the main process reports on each object, in order
+        log.setLevel(logging.WARNING)
+        ParallelMeshes.root.profiler = None
+    initworker = staticmethod(initworker)
+
+    def fill(self):
+        while len(self.pending) < self.window and self.next < len(self.objects):
+            obj = self.objects[self.next]
+            self.next += 1
+            self.pending.append(self.pool.apply_async(meshjob, ((obj.base, obj.limit),)))
+        return self
+
+    def getTriMesh(self, trichunk):
+        """the mesh of a triobject chunk, or None if it wasn't made"""
+        while not self.meshes.has_key(trichunk.base):
+            self.fill()
+            if not self.pending:
+                return None
+            # a timeout on get() keeps ^C working while waiting
+            for base, mesh in self.pending.popleft().get(sys.maxint):
+                self.meshes[base] = mesh
+        return self.meshes.pop(trichunk.base)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        ParallelMeshes.root = None
+        return self
+
+def meshjob(extent):
+    """pool entry point for ParallelMeshes: the (triobject base,
+    TriMesh) pairs of the namedobject chunk at extent (base, limit)"""
+    root = ParallelMeshes.root
+    obj = root.chunkmaker(None, 0x4000)
+    obj.base, obj.limit = extent
+    obj.data = root.data
+    collector = MeshCollector()
+    root.put("writer", collector)
+    root.put("premade", None)
+    obj.eggifyinit(root, None)
+    obj.eggifygeometry(root, None)
+    return [ (tri.base, mesh) for tri, (name, mesh, mtls) in zip(obj.get("triobjects"), collector.meshes) ]
+
+
+class MeshInstances:
+    """finds objects whose geometry repeats that of an earlier object,
+    up to the object's mesh matrix, so that the mesh is made once and
+    the copies refer to it.
+
+    the points are taken back into each object's local space (through
+    the inverse of its mesh matrix) and hashed, rounded, with the uvs,
+    faces, smoothing groups and materials. a hash match is checked
+    point by point before it is believed: the earlier object's points,
+    put through the matrix that takes it onto the new one, must land
+    within tolerance of the new object's own."""
+    # points that close (relative to the mesh size) are the same point
+    TOLERANCE = 1e-5
+
+    def __init__(self):
+        # digest -> the prototypes (dicts) that hashed to it
+        self.prototypes = {}
+
+    def getMatrix(self, trichunk):
+        """an object's mesh matrix, and its inverse"""
+        matrix = trichunk.get("meshmatrix")
+        if matrix is not None:
+            inverse = invertmatrix(matrix)
+            if inverse is not None:
+                return tuple(matrix), inverse
+        # the points are used as they are
+        return IDENTITY_MATRIX, IDENTITY_MATRIX
+
+    def getDigest(self, trichunk, rootchunk, local):
+        """the hash of an object's geometry, given its local points"""
+        digest = hashlib.md5()
+        if len(local) > 0:
+            extent = max(max(local) - min(local), 1e-30)
+            # a power of two, so that near-equal extents round alike
+            quantum = 2.0 ** math.ceil(math.log(extent * MeshInstances.TOLERANCE * 10, 2))
+            digest.update(packarray(array.array("i", [ int(round(v / quantum)) for v in local ])))
+        for key in ("uvarray", "facearray"):
+            digest.update(key)
+            digest.update(packarray(trichunk.get(key)))
+        digest.update("smoothing")
+        if trichunk.get("smoothing") is not None:
+            digest.update(packarray(trichunk.get("smoothing")))
+        for mgrp in trichunk.get("matgroups"):
+            # names that are the same material hash the same
+            mtl = rootchunk.getMaterial(mgrp.get("name"))
+            if mtl is not None:
+                digest.update(repr(mtl.getName()))
+            else:
+                digest.update(repr(mgrp.get("name")))
+            digest.update(packarray(mgrp.get("faces")))
+        return digest.digest()
+
+    def getBatchKey(self, trichunk, rootchunk):
+        """the materials and faces of an object, exactly"""
+        key = []
+        for mgrp in trichunk.get("matgroups"):
+            key.append((rootchunk.getMaterial(mgrp.get("name")) or mgrp.get("name"), mgrp.get("faces").tostring()))
+        return key
+
+    def match(self, trichunk, rootchunk):
+        """(digest, prototype, matrix) for an object whose children
+        have been through eggifygeometry: the prototype is None if no
+        earlier object has the same geometry, and otherwise matrix
+        takes the prototype's points onto this object's"""
+        matrix, inverse = self.getMatrix(trichunk)
+        points = trichunk.get("pointarray")
+        digest = self.getDigest(trichunk, rootchunk, transformpoints(inverse, points))
+        for prototype in self.prototypes.get(digest, ()):
+            if (prototype["facearray"] != trichunk.get("facearray") or
+                prototype["uvarray"] != trichunk.get("uvarray") or
+                prototype["smoothing"] != trichunk.get("smoothing") or
+                prototype["batchkey"] != self.getBatchKey(trichunk, rootchunk)):
+                continue
+            transform = multiplymatrix(matrix, prototype["inverse"])
+            moved = transformpoints(transform, prototype["pointarray"])
+            if len(points) > 0:
+                tolerance = (max(points) - min(points)) * MeshInstances.TOLERANCE * 10
+                tolerance = max(tolerance, rootchunk.get("weldepsilon") or 0.0)
+                if max([ abs(a - b) for a, b in zip(moved, points) ]) > tolerance:
+                    continue
+            return digest, prototype, transform
+        return digest, None, None
+
+    def add(self, digest, trichunk, rootchunk, mesh, mtls, evs=None):
+        """keep an object's mesh for later objects to instance; evs are
+        its EggVertex list, when there is an egg"""
+        matrix, inverse = self.getMatrix(trichunk)
+        prototype = { "name": trichunk.parent.get("name"), "mesh": mesh, "mtls": mtls, "evs": evs,
+                      "inverse": inverse, "pointarray": trichunk.get("pointarray"),
+                      "uvarray": trichunk.get("uvarray"), "facearray": trichunk.get("facearray"),
+                      "smoothing": trichunk.get("smoothing"),
+                      "batchkey": self.getBatchKey(trichunk, rootchunk) }
+        self.prototypes.setdefault(digest, []).append(prototype)
+        return self
+
+
+class MeshFlattener:
+    """a writer that merges the meshes written to it into one mesh per
+    material (and vertex format), and writes those to another writer,
+    so that a scene of many small objects becomes a handful of meshes.
+
+    .3ds points are in world space already, so the objects merge as
+    they are. a merged mesh that would pass vertexcap vertices is
+    written out, and another begun. the object groups are dropped, and
+    what is left of the merged meshes is written on flush()."""
+    def __init__(self, writer, vertexcap=65535):
+        self.writer = writer
+        self.vertexcap = max(3, vertexcap)
+        # (material id, vertex format) -> (material chunk, merged TriMesh)
+        self.merged = {}
+        # the keys of merged, oldest first
+        self.order = []
+        # merged meshes made so far, by material name
+        self.counts = {}
+        self.objects = 0
+        self.written = 0
+
+    def beginGroup(self, tag, name=None):
+        return self
+
+    def endGroup(self):
+        return self
+
+    def writeMaterials(self, mtls):
+        self.writer.writeMaterials(mtls)
+        return self
+
+    def getMerged(self, key, mtl):
+        """the merged mesh being filled for key, begun if need be"""
+        if self.merged.has_key(key):
+            return self.merged[key][1]
+        if mtl is None:
+            matname = "nomaterial"
+        else:
+            matname = mtl.getName()
+        n = self.counts.get(matname, 0)
+        self.counts[matname] = n + 1
+        mesh = TriMesh("flat_%s_%d" % (matname, n))
+        hasuvs, hasnormals, hastangents = key[1]
+        if hasuvs:
+            mesh.uvs = array.array("f")
+        if hasnormals:
+            mesh.normals = array.array("f")
+        if hastangents:
+            mesh.tangents = array.array("f")
+            mesh.binormals = array.array("f")
+        self.merged[key] = (mtl, mesh)
+        self.order.append(key)
+        return mesh
+
+    def writeMerged(self, key):
+        """write out the merged mesh for key"""
+        mtl, mesh = self.merged.pop(key)
+        self.order.remove(key)
+        if mtl is None:
+            mesh.batches = [ (None, 0, mesh.getNumTriangles()) ]
+        else:
+            mesh.batches = [ (mtl.getName(), 0, mesh.getNumTriangles()) ]
+        # a group per merged mesh, as there is one per object otherwise
+        self.writer.beginGroup("<Group>", mesh.name)
+        self.writer.writeMesh(mesh.name, mesh, [ mtl ])
+        self.writer.endGroup()
+        self.written += 1
+        return self
+
+    def writeMesh(self, name, mesh, mtls):
+        """merge a mesh's batches into the merged meshes"""
+        self.objects += 1
+        fmt = (mesh.uvs is not None, mesh.normals is not None, mesh.tangents is not None)
+        triangles = mesh.triangles
+        for batch, mtl in zip(mesh.batches, mtls):
+            matname, first, count = batch
+            key = (id(mtl), fmt)
+            merged = self.getMerged(key, mtl)
+            # vertex of mesh -> vertex of merged
+            remap = {}
+            for t in xrange(first, first + count):
+                tri = triangles[t * 3:t * 3 + 3]
+                if merged.getNumVertices() + 3 > self.vertexcap:
+                    new = len([ v for v in set(tri) if not remap.has_key(v) ])
+                    if merged.getNumVertices() + new > self.vertexcap:
+                        self.writeMerged(key)
+                        merged = self.getMerged(key, mtl)
+                        remap = {}
+                for v in tri:
+                    i = remap.get(v)
+                    if i is None:
+                        i = remap[v] = merged.appendVertex(mesh, v)
+                    merged.triangles.append(i)
+                merged.facenums.append(mesh.facenums[t])
+        return self
+
+    def flush(self):
+        """write out every merged mesh still being filled"""
+        if not self.order:
+            return self
+        for key in list(self.order):
+            self.writeMerged(key)
+        log.info("flattened %d objects into %d meshes", self.objects, self.written)
+        return self
+
+
+class EggWriter:
+    """streams egg syntax straight to a file, without an EggData graph.
+
+    the output is laid out the way EggData.writeEgg lays out what
+    TDSFile.toEgg builds (with the polygon normals main() adds), so
+    the two are interchangeable; the formatting is fixed, so the same
+    input always gives the same bytes."""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.depth = 0
+
+    def line(self, text):
+        self.fileobj.write("  " * self.depth + text + "\n")
+        return self
+
+    def beginGroup(self, tag, name=None):
+        if name:
+            self.line("%s %s {" % (tag, eggname(name)))
+        else:
+            self.line("%s {" % tag)
+        self.depth += 1
+        return self
+
+    def endGroup(self):
+        self.depth -= 1
+        self.line("}")
+        return self
+
+    def scalar(self, name, value):
+        return self.line("<Scalar> %s { %s }" % (name, value))
+
+    def writeTexture(self, name, filename):
+        self.beginGroup("<Texture>", name)
+        self.line(eggstring(filename))
+        self.scalar("format", "rgb")
+        self.scalar("wrapu", "repeat")
+        self.scalar("wrapv", "repeat")
+        self.scalar("minfilter", "linear_mipmap_linear")
+        self.scalar("magfilter", "linear_mipmap_linear")
+        self.endGroup()
+        return self
+
+    def writeMaterial(self, name, diffuse, ambient, specular, shininess):
+        self.beginGroup("<Material>", name)
+        for prefix, rgb in (("diff", diffuse), ("amb", ambient), ("spec", specular)):
+            if rgb is None:
+                continue
+            for channel, value in zip("rgb", rgb):
+                self.scalar(prefix + channel, "%g" % value)
+        if shininess is not None:
+            self.scalar("shininess", "%g" % shininess)
+        self.endGroup()
+        return self
+
+    def writeMaterials(self, mtls):
+        """the texture and material definitions polygons refer to"""
+        # as in toEgg, only textured materials get an <MRef>
+        written = {}
+        for mtl in mtls:
+            if mtl.isTextured() and not written.has_key(mtl.getTextureName()):
+                written[mtl.getTextureName()] = True
+                self.writeTexture(mtl.getTextureName(), mtl.get("texturemap"))
+        for mtl in mtls:
+            if mtl.isTextured():
+                self.writeMaterial(mtl.getName(), mtl.get("diffuse"), mtl.get("ambient"),
+                                   mtl.get("specular"), mtl.get("shininess"))
+        return self
+
+    def polygonNormal(self, positions, a, b, c):
+        """the unit normal of a triangle, or None if it is degenerate"""
+        a, b, c = a * 3, b * 3, c * 3
+        ux = positions[b] - positions[a]
+        uy = positions[b + 1] - positions[a + 1]
+        uz = positions[b + 2] - positions[a + 2]
+        vx = positions[c] - positions[a]
+        vy = positions[c + 1] - positions[a + 1]
+        vz = positions[c + 2] - positions[a + 2]
+        nx = uy * vz - uz * vy
+        ny = uz * vx - ux * vz
+        nz = ux * vy - uy * vx
+        length = math.sqrt(nx * nx + ny * ny + nz * nz)
+        if length == 0.0:
+            return None
+        return (nx / length, ny / length, nz / length)
+
+    def polygonNormals(self, mesh):
+        """the normal (or None) of each of a mesh's triangles"""
+        positions = mesh.positions
+        triangles = mesh.triangles
+        normals = []
+        for t in xrange(0, mesh.getNumTriangles()):
+            tri = triangles[t * 3:t * 3 + 3]
+            normals.append(self.polygonNormal(positions, tri[0], tri[1], tri[2]))
+        return normals
+
+    def writeMesh(self, name, mesh, mtls):
+        """write a vertex pool and its polygons, batch by batch; mtls
+        holds the material chunk (or None) of each batch"""
+        positions = mesh.positions
+        uvs = mesh.uvs
+        vnormals = mesh.normals
+        tangents = mesh.tangents
+        binormals = mesh.binormals
+        triangles = mesh.triangles
+        # degenerate polygons are dropped, as recomputePolygonNormals
+        # does, and then so are the vertices only they used
+        normals = self.polygonNormals(mesh)
+        used = {}
+        for t in xrange(0, mesh.getNumTriangles()):
+            if normals[t] is not None:
+                for v in triangles[t * 3:t * 3 + 3]:
+                    used[v] = True
+        self.beginGroup("<VertexPool>", name)
+        for v in xrange(0, mesh.getNumVertices()):
+            if not used.has_key(v):
+                continue
+            self.beginGroup("<Vertex> %d" % v)
+            self.line(eggfloats(positions[v * 3:v * 3 + 3]))
+            if tangents is not None:
+                self.beginGroup("<UV>")
+                self.line(eggfloats(uvs[v * 2:v * 2 + 2]))
+                self.line("<Tangent> { %s }" % eggfloats(tangents[v * 3:v * 3 + 3]))
+                self.line("<Binormal> { %s }" % eggfloats(binormals[v * 3:v * 3 + 3]))
+                self.endGroup()
+            elif uvs is not None:
+                self.line("<UV> { %s }" % eggfloats(uvs[v * 2:v * 2 + 2]))
+            if vnormals is not None:
+                self.line("<Normal> { %s }" % eggfloats(vnormals[v * 3:v * 3 + 3]))
+            self.endGroup()
+        self.endGroup()
+        self.writePolygons(name, mesh, mtls, normals)
+        return self
+
+    def writePolygons(self, pool, mesh, mtls, normals):
+        """write a mesh's polygons, referring to the vertex pool named
+        pool, given their normals (None for the ones to drop)"""
+        triangles = mesh.triangles
+        indent = "  " * (self.depth + 1)
+        ref = "<Ref> { %s }" % eggname(pool)
+        for batch, mtl in zip(mesh.batches, mtls):
+            matname, first, count = batch
+            # the polygon state is formatted once per batch
+            before = []
+            after = []
+            if mtl is not None:
+                if mtl.isTextured():
+                    before.append(indent + "<TRef> { %s }\n" % eggname(mtl.getTextureName()))
+                    before.append(indent + "<MRef> { %s }\n" % eggname(mtl.getName()))
+                rgb = mtl.get("diffuse")
+                if rgb is not None:
+                    after.append(indent + "<RGBA> { %s }\n" % eggfloats((rgb[0], rgb[1], rgb[2], 1.0)))
+                if mtl.isTwoSided():
+                    after.append(indent + "<BFace> { 1 }\n")
+            before = "".join(before)
+            after = "".join(after)
+            for t in xrange(first, first + count):
+                n = normals[t]
+                if n is None:
+                    continue
+                tri = triangles[t * 3:t * 3 + 3]
+                self.beginGroup("<Polygon>")
+                self.fileobj.write(before)
+                self.line("<Normal> { %s }" % eggfloats(n))
+                self.fileobj.write(after)
+                self.line("<VertexRef> { %d %d %d %s }" % (tri[0], tri[1], tri[2], ref))
+                self.endGroup()
+        return self
+
+    def writeLevel(self, group, name, mesh, mtls, near, far, center):
+        """write one level of detail of a mesh, in a group of its own
+        seen from near to far distance of center"""
+        self.beginGroup("<Group>", group)
+        self.line("<SwitchCondition> { <Distance> { %s <Vertex> { %s } } }" % (eggfloats((far, near)), eggfloats(center)))
+        self.writeMesh(name, mesh, mtls)
+        self.endGroup()
+        return self
+
+    def writeInstance(self, name, mesh, mtls, matrix):
+        """write an <Instance> of a mesh already written, put through a
+        mesh matrix: its polygons use the mesh's own vertex pool, whose
+        positions are taken to be in the instance's space"""
+        self.beginGroup("<Instance>", name)
+        self.beginGroup("<Transform>")
+        self.beginGroup("<Matrix4>")
+        for k in (0, 3, 6, 9):
+            self.line(eggfloats(tuple(matrix[k:k + 3]) + ((k == 9) and 1.0 or 0.0,)))
+        self.endGroup()
+        self.endGroup()
+        self.writePolygons(mesh.name, mesh, mtls, self.polygonNormals(mesh))
+        self.endGroup()
+        return self
+
+
+class GeomWriter:
+    """streams a compact binary geometry file, ready for loading with
+    no text parsing at all.
+
+    the file is a 8-byte header ("3DSG", version, flags, all little
+    endian) followed by records, each a 4-byte tag, a uint32 payload
+    length and the payload. strings are a uint16 length and the bytes.
+      MATL  name, diffuse/ambient/specular (3 floats each), shininess
+            (float), flags (uint32: 1 two-sided, 2 textured), texture
+      MESH  name, vertex format (uint32: 1 normals, 2 uvs, 4 tangents
+            and binormals), vertex count (uint32), the interleaved
+            float32 vertices (position, then normal, uv, tangent and
+            binormal, as present), group count (uint32),
+            then for each group: material index (int32, -1 for none),
+            index size (uint32, 2 or 4), index count (uint32), indices
+      INST  name, mesh index (uint32), mesh matrix (12 floats: the x, y
+            and z axes, then the origin): another object with the
+            geometry of an earlier MESH, put through the matrix
+      LOD   mesh index (uint32), near and far distance, center (3
+            floats): the MESH is a level of detail, seen from near to
+            far distance of center
+      END   no payload
+    MESH records refer to MATL records by their order in the file, and
+    INST records to MESH records the same way; every group is a
+    triangle list. use readGeom() to load one."""
+    MAGIC = "3DSG"
+    VERSION = 1
+    HAS_NORMALS = 1
+    HAS_UVS = 2
+    HAS_TANGENTS = 4
+    TWOSIDED = 1
+    TEXTURED = 2
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.materialindex = {}
+        # the record number of each mesh written (by id, so only good
+        # while the mesh is alive), and how many there have been
+        self.meshindex = {}
+        self.meshcount = 0
+        self.fileobj.write(struct.pack("<4sHH", GeomWriter.MAGIC, GeomWriter.VERSION, 0))
+
+    def record(self, tag, payload):
+        self.fileobj.write(struct.pack("<4sI", tag, len(payload)))
+        self.fileobj.write(payload)
+        return self
+
+    def string(self, s):
+        if s is None:
+            s = ""
+        return struct.pack("<H", len(s)) + s
+
+    def beginGroup(self, tag, name=None):
+        # the binary file has no hierarchy; meshes carry their own names
+        return self
+
+    def endGroup(self):
+        return self
+
+    def writeMaterials(self, mtls):
+        for mtl in mtls:
+            self.materialindex[id(mtl)] = len(self.materialindex)
+            flags = 0
+            if mtl.isTwoSided():
+                flags |= GeomWriter.TWOSIDED
+            if mtl.isTextured():
+                flags |= GeomWriter.TEXTURED
+            values = []
+            for key, default in (("diffuse", (0.5, 0.5, 0.5)), ("ambient", (0.0, 0.0, 0.0)), ("specular", (0.0, 0.0, 0.0))):
+                rgb = mtl.get(key)
+                if rgb is None:
+                    rgb = default
+                values.extend(rgb[0:3])
+            shininess = mtl.get("shininess") or 0
+            payload = (self.string(mtl.getName()) + struct.pack("<10fI", *(values + [shininess, flags])) +
+                       self.string(mtl.get("texturemap")))
+            self.record("MATL", payload)
+        return self
+
+    def writeMesh(self, name, mesh, mtls):
+        """write one mesh record; mtls holds the material chunk (or
+        None) of each of the mesh's batches"""
+        fmt = 0
+        if mesh.normals is not None:
+            fmt |= GeomWriter.HAS_NORMALS
+        if mesh.uvs is not None:
+            fmt |= GeomWriter.HAS_UVS
+        if mesh.tangents is not None:
+            fmt |= GeomWriter.HAS_TANGENTS
+        nverts = mesh.getNumVertices()
+        vertices = array.array("f")
+        positions = mesh.positions
+        normals = mesh.normals
+        uvs = mesh.uvs
+        tangents = mesh.tangents
+        binormals = mesh.binormals
+        for v in xrange(0, nverts):
+            vertices.extend(positions[v * 3:v * 3 + 3])
+            if normals is not None:
+                vertices.extend(normals[v * 3:v * 3 + 3])
+            if uvs is not None:
+                vertices.extend(uvs[v * 2:v * 2 + 2])
+            if tangents is not None:
+                vertices.extend(tangents[v * 3:v * 3 + 3])
+                vertices.extend(binormals[v * 3:v * 3 + 3])
+        # one triangle list per material batch
+        groups = []
+        triangles = mesh.triangles
+        for batch, mtl in zip(mesh.batches, mtls):
+            matname, first, count = batch
+            groups.append((mtl, triangles[first * 3:(first + count) * 3]))
+        if nverts <= 0x10000:
+            indextype, indexsize = "H", 2
+        else:
+            indextype, indexsize = "I", 4
+        parts = [ self.string(name), struct.pack("<II", fmt, nverts), packarray(vertices),
+                  struct.pack("<I", len(groups)) ]
+        for mtl, indices in groups:
+            if mtl is None:
+                matindex = -1
+            else:
+                matindex = self.materialindex.get(id(mtl), -1)
+            parts.append(struct.pack("<iII", matindex, indexsize, len(indices)))
+            parts.append(packarray(array.array(indextype, indices)))
+        self.meshindex[id(mesh)] = self.meshcount
+        self.meshcount += 1
+        self.record("MESH", "".join(parts))
+        return self
+
+    def writeLevel(self, group, name, mesh, mtls, near, far, center):
+        """write a mesh record for one level of detail of a mesh, and
+        the record of the distances it is seen at"""
+        self.writeMesh(name, mesh, mtls)
+        self.record("LOD ", struct.pack("<I5f", self.meshindex[id(mesh)], near, far, *center))
+        return self
+
+    def writeInstance(self, name, mesh, mtls, matrix):
+        """write an instance record of a mesh already written"""
+        self.record("INST", self.string(name) + struct.pack("<I12f", self.meshindex[id(mesh)], *matrix))
+        return self
+
+    def close(self):
+        self.record("END ", "")
+        return self
+
+
+def readGeom(fileobj):
+    """read a file written by GeomWriter.
+
+    returns (materials, meshes): each material is a dict of name,
+    diffuse, ambient, specular, shininess, flags and texture; each mesh
+    a dict of name, format, vertices (a flat float array, interleaved)
+    and groups, a list of (material index, index array). an instance
+    is a mesh too, sharing its format, vertices and groups with the
+    mesh it instances (whose index is its "instance"), with a "matrix"
+    to put them through; other meshes have neither. a level of detail
+    has an "lod" of (near, far, center)."""
+    magic, version, flags = struct.unpack("<4sHH", fileobj.read(8))
+    if magic != GeomWriter.MAGIC or version != GeomWriter.VERSION:
+        raise ValueError("not a version %d 3DSG file" % GeomWriter.VERSION)
+    def string(data, base):
+        n = struct.unpack_from("<H", data, base)[0]
+        return data[base + 2:base + 2 + n], base + 2 + n
+    materials = []
+    meshes = []
+    # the meshes list index of each MESH record
+    meshrecords = []
+    while True:
+        tag, length = struct.unpack("<4sI", fileobj.read(8))
+        data = fileobj.read(length)
+        if tag == "END ":
+            break
+        elif tag == "MATL":
+            name, base = string(data, 0)
+            values = struct.unpack_from("<10fI", data, base)
+            texture, base = string(data, base + 44)
+            materials.append({ "name": name, "diffuse": values[0:3], "ambient": values[3:6],
+                               "specular": values[6:9], "shininess": values[9],
+                               "flags": values[10], "texture": texture or None })
+        elif tag == "MESH":
+            name, base = string(data, 0)
+            fmt, nverts = struct.unpack_from("<II", data, base)
+            base += 8
+            stride = 3
+            if fmt & GeomWriter.HAS_NORMALS:
+                stride += 3
+            if fmt & GeomWriter.HAS_UVS:
+                stride += 2
+            if fmt & GeomWriter.HAS_TANGENTS:
+                stride += 6
+            vertices = unpackarray("f", data, base, nverts * stride)
+            base += nverts * stride * 4
+            ngroups = struct.unpack_from("<I", data, base)[0]
+            base += 4
+            groups = []
+            for i in xrange(0, ngroups):
+                matindex, indexsize, count = struct.unpack_from("<iII", data, base)
+                base += 12
+                indextype = { 2: "H", 4: "I" }[indexsize]
+                groups.append((matindex, unpackarray(indextype, data, base, count)))
+                base += count * indexsize
+            meshrecords.append(len(meshes))
+            meshes.append({ "name": name, "format": fmt, "vertices": vertices, "groups": groups })
+        elif tag == "INST":
+            name, base = string(data, 0)
+            values = struct.unpack_from("<I12f", data, base)
+            index = meshrecords[values[0]]
+            prototype = meshes[index]
+            meshes.append({ "name": name, "format": prototype["format"], "vertices": prototype["vertices"],
+                            "groups": prototype["groups"], "instance": index, "matrix": values[1:] })
+        elif tag == "LOD ":
+            values = struct.unpack_from("<I5f", data, 0)
+            meshes[meshrecords[values[0]]]["lod"] = (values[1], values[2], values[3:6])
+        # unknown records are skipped, so the format can grow
+    return materials, meshes
+
+
+class Profiler:
+    """collects wall time, bytes and counts for one conversion.
+
+    phases (load, subdivide, init, materials, geometry, and whatever
+    the caller adds, such as write) are timed with beginphase/endphase.
+    each chunk a pass visits is timed with enterchunk/leavechunk; the
+    time is exclusive of the subchunks it visits, and includes
+    enumerating its subchunks and, when streaming, writing its output.
+    report() gives it all as a dict, ready for json."""
+    def __init__(self, label=None):
+        self.label = label
+        self.phases = {}
+        self.phasestart = {}
+        self.chunks = {}
+        self.counts = {}
+        self.stack = []
+
+    def beginphase(self, phase):
+        self.phasestart[phase] = time.time()
+        return self
+
+    def endphase(self, phase):
+        seconds = time.time() - self.phasestart.pop(phase)
+        entry = self.phases.setdefault(phase, { "seconds": 0.0, "calls": 0 })
+        entry["seconds"] += seconds
+        entry["calls"] += 1
+        return self
+
+    def count(self, name, n):
+        self.counts[name] = self.counts.get(name, 0) + n
+        return self
+
+    def enterchunk(self, passname, chunk):
+        # [start, time spent in subchunks]
+        self.stack.append([time.time(), 0.0])
+        return self
+
+    def leavechunk(self, passname, chunk):
+        start, inner = self.stack.pop()
+        seconds = time.time() - start
+        if self.stack:
+            self.stack[-1][1] += seconds
+        key = "0x%04x %s" % (chunk.id, chunk.getchunknamebyid(chunk.id))
+        entry = self.chunks.setdefault(passname, {}).setdefault(key, { "seconds": 0.0, "calls": 0, "bytes": 0 })
+        entry["seconds"] += seconds - inner
+        entry["calls"] += 1
+        entry["bytes"] += chunk.limit - chunk.base
+        return self
+
+    def report(self):
+        return { "file": self.label, "phases": self.phases, "chunks": self.chunks, "counts": self.counts }
+
+    def writeJson(self, fileobj, reports=None):
+        """write this report, or a list of reports, as json"""
+        if reports is None:
+            reports = self.report()
+        json.dump(reports, fileobj, indent=2, sort_keys=True)
+        fileobj.write("\n")
+        return self
+
+
 class TDSFile:
     """a representation of an autodesk .3ds file"""
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, usemmap=False):
         self.filename = None
         self.rootchunk = None
+        # vertex welding: weld corners that share a point, or with an
+        # epsilon, corners no further apart than epsilon
+        self.weld = True
+        self.weldepsilon = None
+        # vertex normals from the .3ds smoothing groups
+        self.smoothnormals = False
+        # tangents and binormals (implies smoothnormals)
+        self.tangents = False
+        # a Profiler (or anything with its methods) to time the work
+        self.profiler = None
+        # a TextureResolver for the map names (they are kept as they
+        # are in the file without one)
+        self.textureresolver = None
+        # one material per distinct content, one texture per map, and
+        # a MaterialLibrary to name them consistently across files
+        self.dedupmaterials = True
+        self.materiallibrary = None
+        # with more than one, objects are converted on a ParallelMeshes
+        # pool of this many processes
+        self.objectjobs = 1
+        # make each distinct mesh once, and instances of it for the
+        # objects that repeat it (see MeshInstances)
+        self.instancemeshes = False
+        # merge the objects into a MeshFlattener's meshes, of at most
+        # vertexcap vertices each (with a writer only)
+        self.flatten = False
+        self.vertexcap = 65535
+        # reorder each batch's triangles for the vertex cache
+        self.vertexcache = False
+        # the distances at which each level of detail gives way to the
+        # next, each level with lodratio times the triangles of the last
+        # (no levels without distances)
+        self.loddistances = None
+        self.lodratio = 0.5
         if filename is not None:
-            self.read(filename)
+            self.read(filename, usemmap=usemmap)
 
-    def read(self, filename, verbose=False):
-        if verbose: print "TDSFile.read:", "filename:", filename
+    def read(self, filename, verbose=False, usemmap=False, data=None):
+        """read a .3ds file; given its data, the file has been read
+        already (and is not opened again)"""
+        if verbose: log.debug("TDSFile.read: filename: %s", filename)
         self.filename = filename
-        try:
-            file = open(filename)
-        except:
-            return self
+        if data is None:
+            try:
+                file = open(filename, "rb")
+            except IOError, e:
+                log.error("%s: %s", filename, e)
+                return self
+        if self.profiler is not None: self.profiler.beginphase("load")
         chunk = ChunkRoot(None)
-        chunk.load(file, 0, True)
-        file.close()
+        if data is None:
+            chunk.load(file, 0, verbose, usemmap)
+            file.close()
+        else:
+            chunk.loadData(data, verbose)
+        if self.profiler is not None:
+            self.profiler.endphase("load")
+            self.profiler.count("bytes", chunk.limit - chunk.base)
         if not chunk.isKnownChunkID():
-            print "unknown chunk id:", chunk.id
+            log.warning("%s: unknown chunk id: 0x%04x", filename, chunk.id)
+            chunk.unload()
             return self
-        chunk.subdivide(1, chunk, chunk.data)
+        # the tree is expanded lazily, as the passes walk it
+        if verbose:
+            chunklog.debug("chunk tree of %s:\n%s", filename, ChunkTreeDump(chunk, 1))
         self.rootchunk = chunk
         return self
 
+    def close(self):
+        """drop the chunk tree and release the file data"""
+        if self.rootchunk is not None:
+            self.rootchunk.unload()
+            self.rootchunk = None
+        return self
+
     def __eggifymaterials(self, root, egg):
         #print "__eggifymaterials:", "self:", self
-        for chunk in root.getchildren():
-            chunk.eggifymaterials(root, egg)
+        root.traverse("eggifymaterials", root, egg)
         return self
 
     def __eggifygeometry(self, root, egg):
         #print "__eggifygeometry:", "self:", self
-        for chunk in root.getchildren():
-            chunk.eggifygeometry(root, egg)
+        root.traverse("eggifygeometry", root, egg)
         return self
 
     def __eggifyinit(self, root, egg):
         #print "__eggifyinit:", "self:", self
-        for chunk in root.getchildren():
-            chunk.eggifyinit(root, egg)
+        root.traverse("eggifyinit", root, egg)
+        return self
+
+    def __setoptions(self, root):
+        root.profiler = self.profiler
+        root.put("weld", self.weld)
+        root.put("weldepsilon", self.weldepsilon)
+        root.put("smoothnormals", self.smoothnormals)
+        root.put("tangents", self.tangents)
+        root.put("vertexcache", self.vertexcache)
+        if self.flatten:
+            root.put("loddistances", None)
+        else:
+            root.put("loddistances", self.loddistances)
+        root.put("lodratio", self.lodratio)
+        root.put("textureresolver", self.textureresolver)
+        root.put("dedupmaterials", self.dedupmaterials)
+        root.put("materiallibrary", self.materiallibrary)
+        if self.instancemeshes and not self.flatten and not self.loddistances:
+            root.put("instances", MeshInstances())
+        else:
+            root.put("instances", None)
+        if self.filename is not None:
+            root.put("texturedir", os.path.dirname(self.filename))
+        else:
+            root.put("texturedir", "")
+        return self
+
+    def __convert(self, egg, writer):
+        """run the passes, with the options and writer (if any) on the
+        root chunk where the chunks can find them"""
+        root = self.rootchunk
+        profiler = self.profiler
+        self.__setoptions(root)
+        self.__lockmaterials()
+        try:
+            for phase, run in (("init", self.__eggifyinit), ("materials", self.__eggifymaterials)):
+                if profiler is not None: profiler.beginphase(phase)
+                run(root, egg)
+                if profiler is not None: profiler.endphase(phase)
+        finally:
+            self.__unlockmaterials()
+        if profiler is not None: profiler.beginphase("geometry")
+        premade = None
+        if self.objectjobs > 1 and not self.instancemeshes:
+            # instances are found from the decoded chunks, before any mesh is made
+            premade = self.__parallelMeshes(root)
+        writer = self.__flattened(writer)
+        if writer is not None:
+            writer.writeMaterials(root.getMaterials())
+        root.put("writer", writer)
+        root.put("premade", premade)
+        try:
+            self.__eggifygeometry(root, egg)
+            if isinstance(writer, MeshFlattener):
+                writer.flush()
+        finally:
+            root.put("writer", None)
+            root.put("premade", None)
+            if premade is not None:
+                premade.close()
+        if profiler is not None: profiler.endphase("geometry")
         return self
 
+    def __parallelMeshes(self, root):
+        """a ParallelMeshes for the objects, or None when it can't help"""
+        import multiprocessing
+        if multiprocessing.current_process().daemon:
+            # already a pool worker (-j), which can't have a pool of its own
+            return None
+        objects = []
+        for edit in root.getpasschildren():
+            if edit.id == 0x3d3d:
+                objects.extend([ chunk for chunk in edit.getpasschildren() if chunk.id == 0x4000 ])
+        if len(objects) < 2:
+            return None
+        return ParallelMeshes(root, objects, self.objectjobs)
+
+    def __lockmaterials(self):
+        """hold the material library (if any) while materials are named"""
+        if self.materiallibrary is not None:
+            self.materiallibrary.acquire()
+
+    def __unlockmaterials(self):
+        """let other processes name materials again, once all of ours are"""
+        if self.materiallibrary is not None:
+            self.materiallibrary.release()
+
+    def __writematerials(self, root, writer):
+        self.__unlockmaterials()
+        writer.writeMaterials(root.getMaterials())
+
+    def __flattened(self, writer):
+        """writer, or with flatten on, a MeshFlattener in front of it"""
+        if self.flatten and writer is not None:
+            return MeshFlattener(writer, self.vertexcap)
+        return writer
+
     def toEgg(self, verbose=True):
-        if verbose: print "converting..."
+        if verbose: log.info("converting...")
         # make a new egg
         egg = EggData()
-        self.__eggifyinit(self.rootchunk, egg)
-        self.__eggifymaterials(self.rootchunk, egg)
-        self.__eggifygeometry(self.rootchunk, egg)
+        self.__convert(egg, None)
         return egg
 
-def pathify(path):
-    if os.path.isfile(path):
+    def writeEgg(self, fileobj, verbose=True):
+        """stream the conversion straight to an open file as egg text.
+
+        this needs no panda at all, and never holds more than one
+        object's worth of egg data."""
+        if verbose: log.info("converting (streaming)...")
+        self.__convert(None, EggWriter(fileobj))
+        return self
+
+    def getTriMeshes(self):
+        """decode every object, returning a (name, mesh, mtls) list
+        with the TriMesh and batch material chunks of each"""
+        collector = MeshCollector()
+        self.__convert(None, collector)
+        return collector.meshes
+
+    def writeGeom(self, fileobj, verbose=True):
+        """stream the conversion to an open file in GeomWriter's binary
+        format, skipping egg text altogether"""
+        if verbose: log.info("converting (binary)...")
+        writer = GeomWriter(fileobj)
+        self.__convert(None, writer)
+        writer.close()
+        return self
+
+    def convertStream(self, fileobj, writer):
+        """convert straight from an open .3ds file to a writer
+        (EggWriter, GeomWriter...), without ever holding the whole
+        file: the chunk headers are walked in sequence, and each
+        material and object in the editor chunk is read on its own,
+        converted, and (for objects) dropped again. peak memory then
+        tracks the largest object rather than the scene.
+
+        a seekable file is scanned for offsets first, so that every
+        material is known before the first object is written; from a
+        pipe, materials that come after the first object are lost."""
+        root = ChunkRoot(None)
+        header = fileobj.read(6)
+        if len(header) < 6:
+            raise IOError("truncated .3ds file")
+        root.id, length = struct.unpack("<HI", header)
+        root.limit = length
+        if not root.isKnownChunkID():
+            raise IOError("not a .3ds file (root chunk id 0x%04x)" % root.id)
+        self.rootchunk = root
+        self.__setoptions(root)
+        profiler = self.profiler
+        try:
+            fileobj.seek(0, 1)
+            seekable = True
+        except (IOError, AttributeError):
+            seekable = False
+        if profiler is not None: profiler.beginphase("stream")
+        edit = None
+        pos = 6
+        while pos < root.limit:
+            header = fileobj.read(6)
+            if len(header) < 6:
+                break
+            id, length = struct.unpack("<HI", header)
+            if length < 6:
+                break
+            if id == 0x3d3d:
+                edit = root.chunkmaker(root, id)
+                edit.base = pos
+                edit.limit = pos + length
+                edit.expanded = True
+                break
+            self.__skip(fileobj, length - 6, seekable)
+            pos += length
+        writer = self.__flattened(writer)
+        root.put("writer", writer)
+        self.__lockmaterials()
+        try:
+            if edit is None:
+                self.__writematerials(root, writer)
+            elif seekable:
+                entries = []
+                pos = edit.base + 6
+                while pos < edit.limit:
+                    fileobj.seek(pos)
+                    header = fileobj.read(6)
+                    if len(header) < 6:
+                        break
+                    id, length = struct.unpack("<HI", header)
+                    if length < 6:
+                        break
+                    if id in (0xafff, 0x4000):
+                        entries.append((pos, id, length))
+                    pos += length
+                for pos, id, length in entries:
+                    if id == 0xafff:
+                        fileobj.seek(pos)
+                        self.__streamchunk(root, edit, id, fileobj.read(length), "eggifymaterials")
+                self.__writematerials(root, writer)
+                for pos, id, length in entries:
+                    if id == 0x4000:
+                        fileobj.seek(pos)
+                        self.__streamchunk(root, edit, id, fileobj.read(length), "eggifygeometry")
+            else:
+                written = False
+                pos = edit.base + 6
+                while pos < edit.limit:
+                    header = fileobj.read(6)
+                    if len(header) < 6:
+                        break
+                    id, length = struct.unpack("<HI", header)
+                    if length < 6:
+                        break
+                    if id == 0xafff and written:
+                        log.warning("a material follows the first object, and is ignored")
+                        self.__skip(fileobj, length - 6, seekable)
+                    elif id == 0xafff:
+                        self.__streamchunk(root, edit, id, header + fileobj.read(length - 6), "eggifymaterials")
+                    elif id == 0x4000:
+                        if not written:
+                            self.__writematerials(root, writer)
+                            written = True
+                        self.__streamchunk(root, edit, id, header + fileobj.read(length - 6), "eggifygeometry")
+                    else:
+                        self.__skip(fileobj, length - 6, seekable)
+                    pos += length
+                if not written:
+                    self.__writematerials(root, writer)
+            if isinstance(writer, MeshFlattener):
+                writer.flush()
+        finally:
+            self.__unlockmaterials()
+            root.put("writer", None)
+            root.data = None
+        if profiler is not None:
+            profiler.endphase("stream")
+            profiler.count("bytes", root.limit)
+        return self
+
+    def __streamchunk(self, root, edit, id, data, passname):
+        """run the init pass and one other over a single editor chunk
+        read on its own; its offsets are relative to its own data"""
+        chunk = root.chunkmaker(edit, id)
+        chunk.limit = len(data)
+        chunk.data = data
+        # the decoders find the file data on the root chunk
+        root.data = data
+        profiler = root.profiler
+        for name in ("eggifyinit", passname):
+            if profiler is not None: profiler.enterchunk(name, chunk)
+            getattr(chunk, name)(root, None)
+            if profiler is not None: profiler.leavechunk(name, chunk)
+        root.data = None
+        return chunk
+
+    def __skip(self, fileobj, count, seekable):
+        """step over count bytes of the file"""
+        if seekable:
+            fileobj.seek(count, 1)
+            return
+        while count > 0:
+            block = fileobj.read(min(count, 65536))
+            if not block:
+                return
+            count -= len(block)
+
+    INDEX_VERSION = 1
+
+    def buildIndex(self):
+        """find the offsets of every object and material in the file,
+        reading only chunk headers, names and material groups.
+
+        the index is a dict (it round-trips through json):
+            "edit3ds": [base, length] of the editor chunk
+            "objects": [ { "name", "base", "length", "materials" } ]
+                in file order; "materials" lists the material names
+                the object's faces use
+            "materials": { name: { "base", "length" } }, the last
+                definition of a name winning, as in ChunkRoot"""
+        root = self.rootchunk
+        data = root.data
+        index = { "version": TDSFile.INDEX_VERSION, "edit3ds": None, "objects": [], "materials": {} }
+        for base, id, length in chunkheaders(data, root.base + 6, root.limit):
+            if id == 0x3d3d:
+                index["edit3ds"] = [ base, length ]
+                break
+        if index["edit3ds"] is None:
+            return index
+        base, length = index["edit3ds"]
+        for base, id, length in chunkheaders(data, base + 6, base + length):
+            if id == 0x4000:
+                name, sub = readasciz(data, base + 6)
+                index["objects"].append({ "name": name, "base": base, "length": length,
+                                          "materials": self.__indexObjectMaterials(data, sub, base + length) })
+            elif id == 0xafff:
+                for mbase, mid, mlength in chunkheaders(data, base + 6, base + length):
+                    if mid == 0xa000:
+                        name = readasciz(data, mbase + 6)[0]
+                        index["materials"][name] = { "base": base, "length": length }
+                        break
+        return index
+
+    def __indexObjectMaterials(self, data, base, limit):
+        """the material names used by the triobject chunks of one
+        namedobject, in first-use order"""
+        names = []
+        for tbase, id, length in chunkheaders(data, base, limit):
+            if id != 0x4100:
+                continue
+            for fbase, fid, flength in chunkheaders(data, tbase + 6, tbase + length):
+                if fid != 0x4120:
+                    continue
+                nfaces = struct.unpack_from("<H", data, fbase + 6)[0]
+                for gbase, gid, glength in chunkheaders(data, fbase + 8 + nfaces * 8, fbase + flength):
+                    if gid == 0x4130:
+                        name = readasciz(data, gbase + 6)[0]
+                        if name not in names:
+                            names.append(name)
+        return names
+
+    def getIndexPath(self):
+        """where the index sidecar of this file lives"""
+        return self.filename + ".idx"
+
+    def getIndex(self, sidecar=False):
+        """the object and material index (see buildIndex).
+
+        with sidecar, an index kept next to the file is used if it is
+        still current, and a fresh one is written there otherwise."""
+        if not sidecar:
+            return self.buildIndex()
+        st = os.stat(self.filename)
+        path = self.getIndexPath()
+        try:
+            f = open(path, "r")
+            try:
+                index = json.load(f)
+            finally:
+                f.close()
+            if index.get("version") == TDSFile.INDEX_VERSION and index.get("size") == st.st_size and index.get("mtime") == st.st_mtime:
+                log.debug("using index %s", path)
+                # names are bytes in the file; json hands them back as unicode
+                for entry in index["objects"]:
+                    entry["name"] = entry["name"].encode("latin-1")
+                    entry["materials"] = [ name.encode("latin-1") for name in entry["materials"] ]
+                index["materials"] = dict([ (name.encode("latin-1"), mtl) for name, mtl in index["materials"].items() ])
+                return index
+        except (IOError, ValueError):
+            pass
+        index = self.buildIndex()
+        index["size"] = st.st_size
+        index["mtime"] = st.st_mtime
+        try:
+            f = open(path, "w")
+            try:
+                json.dump(index, f, encoding="latin-1")
+            finally:
+                f.close()
+        except IOError, e:
+            log.warning("can't write index %s: %s", path, e)
+        return index
+
+    def extract(self, names, index=None):
+        """cut the chunk tree down to the named objects and just the
+        materials they use, so that the conversion only ever decodes
+        those. with a memory-mapped file (usemmap), nothing else of
+        the file is even paged in."""
+        if index is None:
+            index = self.getIndex()
+        root = self.rootchunk
+        objects = [ entry for entry in index["objects"] if entry["name"] in names ]
+        missing = [ name for name in names if name not in [ entry["name"] for entry in objects ] ]
+        if missing:
+            raise KeyError("no object named %s in %s" % (", ".join(missing), self.filename))
+        entries = [ (entry["base"], entry["length"], 0x4000) for entry in objects ]
+        used = {}
+        for entry in objects:
+            for name in entry["materials"]:
+                if index["materials"].has_key(name) and not used.has_key(name):
+                    used[name] = True
+                    mtl = index["materials"][name]
+                    entries.append((mtl["base"], mtl["length"], 0xafff))
+        entries.sort()
+        # a fresh root and editor chunk, with only the wanted children
+        edit = root.chunkmaker(None, 0x3d3d)
+        edit.base, length = index["edit3ds"]
+        edit.limit = edit.base + length
+        edit.data = root.data
+        edit.expanded = True
+        for base, length, id in entries:
+            child = root.chunkmaker(edit, id)
+            child.base = base
+            child.limit = base + length
+            child.data = root.data
+            edit.addChild(child)
+        pruned = root.chunkmaker(None, root.id)
+        pruned.base = root.base
+        pruned.limit = root.limit
+        pruned.data = root.data
+        pruned.expanded = True
+        pruned.addChild(edit)
+        self.rootchunk = pruned
+        log.info("extracted %d objects and %d materials", len(objects), len(used))
+        return self
+
+    def getTexturePaths(self):
+        """the texture map names used by the materials seen so far"""
+        paths = {}
+        for mtl in self.rootchunk.materialsbyname.values():
+            if mtl.isTextured():
+                paths[mtl.get("texturemap")] = True
+        paths = paths.keys()
+        paths.sort()
+        return paths
+
+
+class ConversionCache:
+    """an on-disk cache of converted .egg files.
+
+    entries are keyed on the content of the source file, the options
+    that change the output and the converter itself. each entry also
+    records the texture paths the egg refers to, and whether they
+    existed, so an entry goes stale when a texture appears or vanishes.
+    the least recently used entries are evicted past maxbytes."""
+    # options that do not change what ends up in the .egg
+    IGNORED_OPTIONS = ("-s", "--show", "-d", "--dump", "-j", "--jobs", "--pipeline",
+                       "-J", "--objectjobs",
+                       "-m", "--mmap", "-c", "--cache", "--cache-size",
+                       "-q", "--quiet", "-v", "--verbose", "--index",
+                       "-l", "--lowmem", "--profile")
+    converterdigest = None
+
+    def __init__(self, directory, maxbytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another process may have just made it
+                if not os.path.isdir(directory):
+                    raise
+
+    def getConverterDigest(self):
+        if ConversionCache.converterdigest is None:
+            src = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+            ConversionCache.converterdigest = self.digestFile(src)
+        return ConversionCache.converterdigest
+
+    def digestFile(self, filename):
+        h = hashlib.sha1()
+        f = open(filename, "rb")
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            h.update(block)
+        f.close()
+        return h.hexdigest()
+
+    def key(self, infile, opts):
+        h = hashlib.sha1()
+        h.update(self.getConverterDigest())
+        h.update(self.digestFile(infile))
+        for o, a in opts:
+            if o not in ConversionCache.IGNORED_OPTIONS:
+                h.update("%s=%s;" % (o, a))
+        return h.hexdigest()
+
+    def textureState(self, outfile, paths):
+        """[path, exists] for each texture path, as seen from outfile"""
+        base = os.path.dirname(outfile)
+        return [ [path, os.path.isfile(os.path.join(base, path))] for path in paths ]
+
+    def fetch(self, key, outfile):
+        """copy a cached conversion to outfile; False on a miss"""
+        egg = os.path.join(self.directory, key + ".egg")
+        meta = os.path.join(self.directory, key + ".json")
+        try:
+            f = open(meta, "rb")
+            textures = json.load(f)["textures"]
+            f.close()
+            paths = [ path for path, exists in textures ]
+            if self.textureState(outfile, paths) != textures:
+                return False
+            shutil.copyfile(egg, outfile)
+            # the mtime is the lru timestamp
+            os.utime(egg, None)
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+        return True
+
+    def store(self, key, outfile, paths):
+        """copy a fresh conversion into the cache, then trim it"""
+        egg = os.path.join(self.directory, key + ".egg")
+        meta = os.path.join(self.directory, key + ".json")
+        # write under temporary names, so other processes never see a
+        # partial entry
+        tmp = "%s.%d.tmp" % (egg, os.getpid())
+        shutil.copyfile(outfile, tmp)
+        os.rename(tmp, egg)
+        f = open(meta + ".tmp%d" % os.getpid(), "wb")
+        json.dump({ "source": outfile, "textures": self.textureState(outfile, paths) }, f)
+        f.close()
+        os.rename(meta + ".tmp%d" % os.getpid(), meta)
+        self.evict()
+        return self
+
+    def evict(self):
+        """remove least recently used entries until under maxbytes"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".egg"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+            total += st.st_size
+        entries.sort()
+        for mtime, name, size in entries:
+            if total <= self.maxbytes:
+                break
+            key = name[:-len(".egg")]
+            for path in (key + ".egg", key + ".json"):
+                try:
+                    os.remove(os.path.join(self.directory, path))
+                except OSError:
+                    pass
+            total -= size
+        return self
+
+class TextureResolver:
+    """finds the files that .3ds map names refer to.
+
+    map names are often written on win32, with \\'s in them, a full
+    rather than relative pathname (Hexagon does this... ick) and
+    whatever case the artist typed. a full path that exists is used as
+    it is; otherwise each name is looked for next to the .3ds file,
+    then in each of the search paths, first as the relative path it
+    gives and then as a bare file name, matching every path component
+    without regard to case, and last as given, from the current
+    directory.
+
+    a directory is listed once, the first time it is needed, and
+    every answer is remembered, so one resolver shared across a batch
+    of files sharing a texture library touches the disk once per
+    directory rather than once per name."""
+
+    shared = {}
+
+    def __init__(self, searchpaths=()):
+        self.searchpaths = list(searchpaths)
+        # directory -> { lowercased name: name on disk }
+        self.listings = {}
+        # (basedir, mapname) -> resolved path or None
+        self.found = {}
+
+    def getShared(cls, searchpaths=()):
+        """the resolver for these search paths, made once per process"""
+        key = tuple(searchpaths)
+        if not cls.shared.has_key(key):
+            cls.shared[key] = cls(searchpaths)
+        return cls.shared[key]
+    getShared = classmethod(getShared)
+
+    def listing(self, directory):
+        if not self.listings.has_key(directory):
+            names = {}
+            try:
+                for name in os.listdir(directory or "."):
+                    names.setdefault(name.lower(), name)
+            except OSError:
+                pass
+            self.listings[directory] = names
+        return self.listings[directory]
+
+    def lookup(self, directory, parts):
+        """the path of parts below directory, matched regardless of
+        case, or None"""
+        path = directory
+        for part in parts:
+            if part in ("", "."):
+                continue
+            name = self.listing(path).get(part.lower())
+            if name is None:
+                return None
+            path = os.path.join(path, name)
+        return path
+
+    def find(self, mapname, basedir=""):
+        """the path to use for mapname in a file written to basedir,
+        or None if it is nowhere to be found"""
+        key = (basedir, mapname)
+        if self.found.has_key(key):
+            return self.found[key]
+        if os.path.isabs(mapname) and os.path.isfile(mapname):
+            # a full path that is there already is used as it is
+            self.found[key] = mapname
+            return mapname
+        parts = mapname.replace("\\", "/").split("/")
+        candidates = [ parts[-1:] ]
+        if len(parts) > 1 and parts[0] != "" and not parts[0].endswith(":"):
+            # a relative path is tried as such before the bare name
+            candidates.insert(0, parts)
+        path = None
+        for directory in [ basedir ] + self.searchpaths:
+            for candidate in candidates:
+                path = self.lookup(directory, candidate)
+                if path is not None:
+                    break
+            if path is not None:
+                break
+        if path is None and os.path.isfile(mapname):
+            # there as given, from where we were run
+            path = mapname
+        if path is not None and not os.path.isabs(path):
+            path = os.path.relpath(path, basedir or ".")
+        self.found[key] = path
         return path
-    # if it was written on win32, it may have \'s in it, and
-    # also a full rather than relative pathname (Hexagon does this... ick)
-    orig = path
-    path = path.lower()
-    path = path.replace("\\", "/")
-    h, t = os.path.split(path)
-    if os.path.isfile(t):
-        return t
-    print "warning: can't make sense of this map file name:", orig
-    return t
-    
+
+    def resolve(self, mapname, basedir=""):
+        """like find, but falls back on the map name as it is (with a
+        warning, once per name)"""
+        warned = self.found.has_key((basedir, mapname))
+        path = self.find(mapname, basedir)
+        if path is not None:
+            return path
+        if not warned:
+            log.warning("can't make sense of this map file name: %s", mapname)
+        return mapname
+
+def pathify(path):
+    return TextureResolver.getShared().resolve(path)
+
+
+class MaterialLibrary:
+    """names materials (by content) and textures (by path) the same way
+    in every file of a batch, kept in a json file between runs.
+
+    the first name seen for a material or texture becomes its library
+    name; a different material or texture wanting a name already taken
+    gets a numbered one. names are only handed out between acquire()
+    and release(): acquire() locks the file and merges in what other
+    processes saved meanwhile, and release() saves the new names before
+    unlocking, so -j workers never name the same material twice."""
+
+    shared = {}
+
+    def __init__(self, path=None):
+        self.path = path
+        # repr(content key) -> name, and texture path -> name
+        self.materials = {}
+        self.textures = {}
+        self.dirty = False
+        self.lock = None
+        if path is not None:
+            self.merge(self.load(path))
+
+    def getShared(cls, path):
+        """the library kept in path, loaded once per process"""
+        if not cls.shared.has_key(path):
+            cls.shared[path] = cls(path)
+        return cls.shared[path]
+    getShared = classmethod(getShared)
+
+    def load(self, path):
+        try:
+            f = open(path, "rb")
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return { "materials": {}, "textures": {} }
+        # names are bytes in the .3ds files
+        for table in ("materials", "textures"):
+            data[table] = dict([ (k.encode("latin-1"), v.encode("latin-1")) for k, v in data.get(table, {}).items() ])
+        return data
+
+    def merge(self, data):
+        for table, entries in ((self.materials, data["materials"]), (self.textures, data["textures"])):
+            taken = dict([ (name, True) for name in table.values() ])
+            for key, name in entries.items():
+                if not table.has_key(key) and not taken.has_key(name):
+                    table[key] = name
+                    taken[name] = True
+        return self
+
+    def uniqueName(self, table, key, name):
+        if table.has_key(key):
+            return table[key]
+        taken = dict([ (n, True) for n in table.values() ])
+        unique = name
+        n = 1
+        while taken.has_key(unique):
+            unique = "%s_%d" % (name, n)
+            n += 1
+        table[key] = unique
+        self.dirty = True
+        return unique
+
+    def getMaterialName(self, key, name):
+        """the library name of the material with this content key"""
+        return self.uniqueName(self.materials, repr(key), name)
+
+    def getTextureName(self, path, name):
+        """the library name of the texture of this map path"""
+        return self.uniqueName(self.textures, path, name)
+
+    def acquire(self):
+        """lock the library file, and catch up with it"""
+        if self.path is None or self.lock is not None:
+            return self
+        import fcntl
+        lock = open(self.path + ".lock", "wb")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        self.lock = lock
+        mine = { "materials": self.materials, "textures": self.textures }
+        # what was saved first wins, then ours fills in the rest
+        self.materials = {}
+        self.textures = {}
+        self.merge(self.load(self.path))
+        self.merge(mine)
+        return self
+
+    def release(self):
+        """write back the names given out since acquire(), and unlock"""
+        if self.lock is None:
+            return self
+        import fcntl
+        try:
+            if self.dirty:
+                tmp = "%s.%d.tmp" % (self.path, os.getpid())
+                f = open(tmp, "wb")
+                json.dump({ "materials": self.materials, "textures": self.textures }, f,
+                          encoding="latin-1", indent=1, sort_keys=True)
+                f.close()
+                os.rename(tmp, self.path)
+                self.dirty = False
+        finally:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+            self.lock.close()
+            self.lock = None
+        return self
+
+
+def writefile(path, data):
+    f = open(path, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+def convertfile(infile, opts, data=None, defer=None):
+    """convert one .3ds file to an .egg next to it.
+
+    returns (infile, ok, seconds, message, cachestate, profile) rather
+    than raising, so that batch runs can report on every file.
+    cachestate is "hit", "miss" or None when no cache is in use, and
+    profile is a Profiler report with --profile, None otherwise.
+
+    data is the file's contents, if they have been read already. with
+    defer, the output is not written here: defer(write, after) is
+    called instead, and whoever calls write() and then after() does
+    the writing (and caching, and showing) of the output."""
+    start = time.time()
+    profiler = None
+    def finish(ok, message, cachestate):
+        report = None
+        if profiler is not None:
+            report = profiler.report()
+            report["seconds"] = time.time() - start
+            report["ok"] = ok
+        return (infile, ok, time.time() - start, message, cachestate, report)
+    show = False
+    usemmap = False
+    dump = False
+    weld = True
+    weldepsilon = None
+    smooth = False
+    tangents = False
+    stream = not HAVE_PANDA
+    geom = False
+    cachedir = None
+    cachesize = 1024 * 1024 * 1024
+    objects = []
+    sidecar = False
+    lowmem = False
+    searchpaths = []
+    dedup = True
+    matlib = None
+    objectjobs = 1
+    instance = False
+    flatten = False
+    vertexcap = 65535
+    vertexcache = False
+    loddistances = None
+    lodratio = 0.5
+    for o, a in opts:
+        if o in ("-s", "--show"):
+            show = True
+        elif o in ("-m", "--mmap"):
+            usemmap = True
+        elif o in ("-d", "--dump"):
+            dump = True
+        elif o in ("-w", "--weld"):
+            weldepsilon = float(a)
+        elif o == "--noweld":
+            weld = False
+        elif o in ("-e", "--stream"):
+            stream = True
+        elif o in ("-N", "--smoothgroups"):
+            smooth = True
+        elif o in ("-b", "--binormals", "-t", "--tangents"):
+            tangents = True
+        elif o in ("-g", "--geom"):
+            geom = True
+        elif o in ("-c", "--cache"):
+            cachedir = a
+        elif o == "--cache-size":
+            cachesize = int(float(a) * 1024 * 1024)
+        elif o == "--profile":
+            profiler = Profiler(infile)
+        elif o in ("-o", "--object"):
+            objects.append(a)
+            usemmap = True
+        elif o == "--index":
+            sidecar = True
+        elif o in ("-l", "--lowmem"):
+            lowmem = True
+        elif o in ("-p", "--texturepath"):
+            searchpaths.append(a)
+        elif o == "--nodedup":
+            dedup = False
+        elif o == "--matlib":
+            matlib = a
+        elif o in ("-J", "--objectjobs"):
+            objectjobs = int(a)
+        elif o in ("-i", "--instance"):
+            instance = True
+        elif o in ("-F", "--flatten"):
+            flatten = True
+        elif o == "--vertexcap":
+            vertexcap = int(a)
+        elif o in ("-r", "--reorder"):
+            vertexcache = True
+        elif o == "--lod":
+            loddistances = floats(a.split(","))
+        elif o == "--lodratio":
+            lodratio = float(a)
+    cachestate = None
+    try:
+        if ".3ds" not in infile and ".3DS" not in infile:
+            log.warning("%s does not look like a valid .3ds file", infile)
+            return finish(False, "not a .3ds file", cachestate)
+        f, e = os.path.splitext(infile)
+        if geom:
+            outfile = f + ".3dg"
+        else:
+            outfile = f + ".egg"
+        cache = None
+        if cachedir is not None and matlib is not None:
+            # the names in the output depend on the library as it was
+            log.warning("the cache is not used with --matlib")
+        elif cachedir is not None and os.path.isfile(infile):
+            cache = ConversionCache(cachedir, cachesize)
+            key = cache.key(infile, opts)
+            if cache.fetch(key, outfile):
+                log.info("cached: %s", infile)
+                # nothing was converted, so there is nothing to profile
+                profiler = None
+                if show and not geom:
+                    os.system("pview " + outfile)
+                return finish(True, outfile, "hit")
+            cachestate = "miss"
+        tds = TDSFile()
+        tds.weld = weld
+        tds.weldepsilon = weldepsilon
+        tds.smoothnormals = smooth
+        tds.tangents = tangents
+        tds.profiler = profiler
+        tds.textureresolver = TextureResolver.getShared(searchpaths)
+        tds.dedupmaterials = dedup or matlib is not None
+        tds.objectjobs = objectjobs
+        tds.instancemeshes = instance
+        tds.flatten = flatten
+        tds.vertexcap = vertexcap
+        tds.vertexcache = vertexcache
+        tds.loddistances = loddistances
+        tds.lodratio = lodratio
+        if flatten:
+            # the objects are merged on their way to a writer
+            stream = True
+        if matlib is not None:
+            tds.materiallibrary = MaterialLibrary.getShared(matlib)
+        lowmem = lowmem and not objects and data is None
+        if lowmem:
+            # never the whole file in memory, so never a whole egg either
+            stream = True
+        else:
+            tds.read(infile, dump or chunklog.isEnabledFor(logging.DEBUG), usemmap, data)
+            if tds.rootchunk is None:
+                return finish(False, "could not read file", cachestate)
+            if objects:
+                tds.extract(objects, tds.getIndex(sidecar))
+            elif sidecar:
+                tds.getIndex(True)
+        if stream or geom:
+            if defer is None:
+                out = open(outfile, "wb")
+            else:
+                out = cStringIO.StringIO()
+            try:
+                if lowmem:
+                    log.info("converting (one object at a time)...")
+                    if geom:
+                        writer = GeomWriter(out)
+                    else:
+                        writer = EggWriter(out)
+                    src = open(infile, "rb")
+                    tds.filename = infile
+                    try:
+                        tds.convertStream(src, writer)
+                    finally:
+                        src.close()
+                    if geom:
+                        writer.close()
+                elif geom:
+                    tds.writeGeom(out)
+                else:
+                    tds.writeEgg(out)
+            finally:
+                if defer is None:
+                    out.close()
+            for o, a in opts:
+                if o in ("-n", "--normals", "--pandabinormals"):
+                    log.warning("%s needs panda, and is ignored when streaming", o)
+            textures = tds.getTexturePaths()
+            tds.close()
+            def after():
+                if cache is not None:
+                    cache.store(key, outfile, textures)
+                if show and not geom:
+                    os.system("pview " + outfile)
+            if defer is None:
+                after()
+            else:
+                output = out.getvalue()
+                defer(lambda: writefile(outfile, output), after)
+            return finish(True, outfile, cachestate)
+        egg = tds.toEgg()
+        textures = tds.getTexturePaths()
+        tds.close()
+        if profiler is not None: profiler.beginphase("recompute")
+        for o, a in opts:
+            if o in ("-n", "--normals"):
+                log.info("recomputing vertex normals...")
+                egg.recomputeVertexNormals(float(a))
+            elif o == "--pandabinormals":
+                log.info("recomputing tangent binormals...")
+                egg.recomputeTangentBinormal(GlobPattern(""))
+        log.info("removing unreferenced vertices...")
+        egg.removeUnusedVertices(GlobPattern(""))
+        if True:
+            log.info("recomputing polygon normals...")
+            egg.recomputePolygonNormals()
+        if profiler is not None: profiler.endphase("recompute")
+        def after():
+            if cache is not None:
+                cache.store(key, outfile, textures)
+            if show:
+                os.system("pview " + outfile)
+        if defer is None:
+            if profiler is not None: profiler.beginphase("write")
+            egg.writeEgg(Filename(outfile))
+            if profiler is not None: profiler.endphase("write")
+            after()
+        else:
+            defer(lambda: egg.writeEgg(Filename(outfile)), after)
+    except Exception, e:
+        log.error("%s: %s", infile, e)
+        log.debug("traceback:", exc_info=True)
+        return finish(False, "%s: %s" % (e.__class__.__name__, e), cachestate)
+    return finish(True, outfile, cachestate)
+
+def convertjob(job):
+    """pool entry point; job is an (infile, opts) tuple"""
+    return convertfile(*job)
+
+def convertbatch(infiles, opts, jobs):
+    """convert infiles on a pool of jobs processes.
+
+    every file is converted independently; the results come back in
+    the same order as infiles."""
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # a timeout on get() keeps ^C working while waiting on the pool
+        results = pool.map_async(convertjob, [ (infile, opts) for infile in infiles ], 1).get(sys.maxint)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    pool.join()
+    return results
+
+def convertpipeline(infiles, opts, depth=2):
+    """convert infiles one at a time, but with the reading of the next
+    files and the writing of the last ones overlapping the conversion.
+
+    a reader thread reads up to depth files ahead, and a writer thread
+    writes up to depth finished outputs behind; the queues between the
+    stages are bounded, so no more than that is ever held in memory.
+    the results come back in the same order as infiles."""
+    import threading
+    import Queue
+    results = [ None ] * len(infiles)
+    # the writer may finish a file before its result is in results
+    failures = {}
+    reads = Queue.Queue(depth)
+    writes = Queue.Queue(depth)
+
+    def reader():
+        for i, infile in enumerate(infiles):
+            data = None
+            try:
+                f = open(infile, "rb")
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+            except Exception:
+                # (MemoryError too) convertfile tries again, and reports
+                # it; the main thread must not wait on a dead reader
+                data = None
+            reads.put((i, infile, data))
+
+    def writer():
+        while True:
+            job = writes.get()
+            if job is None:
+                return
+            i, write, after = job
+            try:
+                write()
+                after()
+            except Exception, e:
+                log.error("%s: %s", infiles[i], e)
+                failures[i] = "%s: %s" % (e.__class__.__name__, e)
+
+    threads = [ threading.Thread(target=reader), threading.Thread(target=writer) ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for n in xrange(0, len(infiles)):
+        i, infile, data = reads.get()
+        def defer(write, after, i=i):
+            writes.put((i, write, after))
+        results[i] = convertfile(infile, opts, data, defer)
+        # let go of the input before the next one is taken
+        data = None
+    writes.put(None)
+    threads[1].join()
+    for i, message in failures.items():
+        infile, ok, seconds, x, cachestate, profile = results[i]
+        results[i] = (infile, False, seconds, message, cachestate, profile)
+    return results
+
+def printsummary(results, wall):
+    """print one line per file, in input order, and the totals"""
+    failed = 0
+    total = 0.0
+    hits = 0
+    misses = 0
+    print "summary:"
+    for infile, ok, seconds, message, cachestate, profile in results:
+        total += seconds
+        if cachestate == "hit":
+            hits += 1
+        elif cachestate == "miss":
+            misses += 1
+        if cachestate == "hit":
+            print "    cached %8.3fs %s" % (seconds, infile)
+        elif ok:
+            print "    ok     %8.3fs %s" % (seconds, infile)
+        else:
+            failed += 1
+            print "    FAILED %8.3fs %s (%s)" % (seconds, infile, message)
+    print "%d files, %d converted, %d failed, %.3fs converting, %.3fs elapsed" % (len(results), len(results) - failed, failed, total, wall)
+    if hits or misses:
+        print "cache: %d hits, %d misses" % (hits, misses)
+    return failed
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv
     try:
-        opts, args = getopt.getopt(argv[1:], "hn:bs", ["help", "normals", "binormals", "show"])
+        opts, args = getopt.getopt(argv[1:], "hn:btsmdj:c:w:egNqvo:lp:J:iFr", ["help", "normals", "binormals", "show", "mmap", "dump", "jobs=", "cache=", "cache-size=", "weld=", "noweld", "stream", "geom", "smoothgroups", "tangents", "pandabinormals",
+                                                      "profile=", "quiet", "verbose", "object=", "index", "lowmem", "texturepath=", "nodedup", "matlib=", "pipeline", "objectjobs=", "instance", "flatten", "vertexcap=", "reorder", "lod=", "lodratio="])
     except getopt.error, msg:
         print msg
         print __doc__
         return 2
-    show = False
+    jobs = 1
+    profile = None
+    pipeline = False
+    level = logging.INFO
+    dump = False
     for o, a in opts:
         if o in ("-h", "--help"):
             print __doc__
             return 0
-        elif o in ("-s", "--show"):
-            show = True
-    for infile in args:
-        try:
-            if ".3ds" not in infile and ".3DS" not in infile:
-                print "WARNING", infile, "does not look like a valid .3ds file"
-                continue
-            tds = TDSFile(infile)
-            egg = tds.toEgg()
-            f, e = os.path.splitext(infile)
-            outfile = f + ".egg"
-            for o, a in opts:
-                if o in ("-n", "--normals"):
-                    print "recomputing vertex normals..."
-                    egg.recomputeVertexNormals(float(a))
-                elif o in ("-b", "--binormals"):
-                    print "recomputing tangent binormals..."
-                    egg.recomputeTangentBinormal(GlobPattern(""))
-            print "removing unreferenced vertices..."
-            egg.removeUnusedVertices(GlobPattern(""))
-            if True:
-                print "recomputing polygon normals..."
-                egg.recomputePolygonNormals()
-            egg.writeEgg(Filename(outfile))
-            if show:
-                os.system("pview " + outfile)
-        except Exception,e:
-            print e
+        elif o in ("-j", "--jobs"):
+            jobs = int(a)
+        elif o == "--profile":
+            profile = a
+        elif o in ("-q", "--quiet"):
+            level = logging.WARNING
+        elif o in ("-v", "--verbose"):
+            level = logging.DEBUG
+        elif o in ("-d", "--dump"):
+            dump = True
+        elif o == "--pipeline":
+            pipeline = True
+    if level == logging.DEBUG:
+        logging.basicConfig(level=level, format="%(levelname)s %(name)s: %(message)s")
+    else:
+        logging.basicConfig(level=level, format="%(message)s")
+    if dump:
+        chunklog.setLevel(logging.DEBUG)
+    start = time.time()
+    if jobs > 1 and len(args) > 1:
+        results = convertbatch(args, opts, jobs)
+    elif pipeline and len(args) > 1:
+        results = convertpipeline(args, opts)
+    else:
+        results = [ convertfile(infile, opts) for infile in args ]
+    if profile is not None:
+        f = open(profile, "w")
+        Profiler().writeJson(f, [ r[5] for r in results if r[5] is not None ])
+        f.close()
+    cached = [ r for r in results if r[4] is not None ]
+    if len(results) > 1 or cached:
+        printsummary(results, time.time() - start)
+    if [ r for r in results if not r[1] ]:
+        return 1
     return 0
 
 if __name__ == "__main__":
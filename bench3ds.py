@@ -0,0 +1,223 @@
+#!/usr/bin/python
+# vim:tabstop=4:shiftwidth=4:syntax=python:expandtab
+"""
+    bench3ds.py [t#,#,...][o#][m#][x#][k#][f#][r#][j file][keep dir]
+        -t triangle counts to scale through (default 1000,10000,100000,1000000)
+        -o objects per file, at least (more are used when an object
+            would pass the 65535 vertex or face limit; default 1)
+        -m materials (default 4)
+        -x how many of the materials are texture mapped (default 2)
+        -k smoothing groups (default 4)
+        -f keyframer nodes per object, as noise the converter skips (default 2)
+        -r repeats per size; the best time is kept (default 1)
+        -j also write the results to this json file
+        --keep=dir  keep the generated .3ds (and output) files in dir
+
+    writes synthetic .3ds files of the requested size, using the chunk
+    ids in TDSChunk.CHUNK_ATTRIB, then times TDSFile.read, the
+    conversion (toEgg, or decoding into TriMeshes without panda) and
+    the write step (EggData.writeEgg, or EggWriter without panda).
+"""
+
+import imp
+import array
+import getopt
+import json
+import math
+import shutil
+import struct
+import tempfile
+import time
+import sys, os
+
+tds2egg = imp.load_source("tds2egg", os.path.join(os.path.dirname(os.path.abspath(__file__)), "3ds2egg.py"))
+
+# chunk ids by the names 3ds2egg knows them by
+CHUNK_ID = dict([ (attr["name"], id) for id, attr in tds2egg.TDSChunk.CHUNK_ATTRIB.items() ])
+
+# the widest grid whose vertex and face counts both fit an unsigned short
+MAXSIDE = 182
+
+
+def chunk(name, payload="", children=()):
+    """the bytes of one chunk, header and all"""
+    body = payload + "".join(children)
+    return struct.pack("<HI", CHUNK_ID[name], 6 + len(body)) + body
+
+def asciz(s):
+    return s + "\0"
+
+def color24(rgb):
+    return chunk("color24", struct.pack("BBB", *rgb))
+
+def percentage(p):
+    return chunk("percentage", struct.pack("<H", p))
+
+def material(i, textured):
+    rgb = ((i * 53) % 256, (i * 97) % 256, (i * 151) % 256)
+    children = [ chunk("materialname", asciz("mat%d" % i)),
+                 chunk("ambient", "", [ color24((rgb[0] // 8, rgb[1] // 8, rgb[2] // 8)) ]),
+                 chunk("diffuse", "", [ color24(rgb) ]),
+                 chunk("specular", "", [ color24((255, 255, 255)) ]),
+                 chunk("shininess", "", [ percentage(20) ]),
+                 chunk("transparency", "", [ percentage(0) ]) ]
+    if i % 5 == 4:
+        children.append(chunk("twosided"))
+    if textured:
+        children.append(chunk("texturemap", "", [ percentage(100), chunk("mapname", asciz("tex%d.png" % i)) ]))
+    return chunk("material", "", children)
+
+def gridobject(name, side, materials, smoothgroups, offset):
+    """a side x side vertex grid, rippled, with its faces banded across
+    the materials and smoothing groups"""
+    points = array.array("f")
+    uvs = array.array("f")
+    for j in xrange(0, side):
+        for i in xrange(0, side):
+            points.extend((i + offset, j, math.sin(i * 0.3) * math.cos(j * 0.3)))
+            uvs.extend((i / float(side - 1), j / float(side - 1)))
+    faces = array.array("H")
+    for j in xrange(0, side - 1):
+        for i in xrange(0, side - 1):
+            a = j * side + i
+            faces.extend((a, a + 1, a + side + 1, 7, a, a + side + 1, a + side, 7))
+    nfaces = len(faces) // 4
+    rows = side - 1
+    children = []
+    for m in xrange(0, materials):
+        # one band of rows per material
+        first = rows * m // materials * rows * 2
+        last = rows * (m + 1) // materials * rows * 2
+        facenums = array.array("H", xrange(first, last))
+        children.append(chunk("meshmatgroup", asciz("mat%d" % m) + struct.pack("<H", len(facenums)) + tds2egg.packarray(facenums)))
+    if smoothgroups:
+        masks = array.array("I", [ 1 << ((f // (rows * 2) * smoothgroups // rows) % 32) for f in xrange(0, nfaces) ])
+        children.append(chunk("smoothgroup", tds2egg.packarray(masks)))
+    matrix = struct.pack("<12f", 1, 0, 0, 0, 1, 0, 0, 0, 1, offset, 0, 0)
+    tri = chunk("triobject", "", [ chunk("points", struct.pack("<H", side * side) + tds2egg.packarray(points)),
+                                    chunk("uvs", struct.pack("<H", side * side) + tds2egg.packarray(uvs)),
+                                    chunk("faces", struct.pack("<H", nfaces) + tds2egg.packarray(faces), children),
+                                    chunk("meshmatrix", matrix) ])
+    return chunk("namedobject", asciz(name), [ tri ])
+
+def keyframernode(name):
+    return chunk("objectnodetag", "", [ chunk("nodeid", struct.pack("<H", 0)),
+                                        chunk("nodeheader", asciz(name) + struct.pack("<HHH", 0, 0, 0xffff)),
+                                        chunk("pivot", struct.pack("<3f", 0, 0, 0)),
+                                        chunk("trackpos", "\0" * 10 + struct.pack("<I", 1) + "\0" * 6 + struct.pack("<3f", 0, 0, 0)) ])
+
+def synthesize(triangles, objects=1, materials=4, textured=2, smoothgroups=4, keyframes=2):
+    """(bytes, triangles, objects) of a .3ds with about this many triangles"""
+    objects = max(objects, int(math.ceil(triangles / (2.0 * (MAXSIDE - 1) ** 2))))
+    pertri = max(2, triangles // objects)
+    side = min(MAXSIDE, max(2, int(math.sqrt(pertri / 2.0)) + 1))
+    mats = [ material(i, i < textured) for i in xrange(0, materials) ]
+    objs = [ gridobject("obj%d" % i, side, max(1, materials), smoothgroups, i * side) for i in xrange(0, objects) ]
+    edit = chunk("edit3ds", "", [ chunk("meshversion", struct.pack("<I", 3)), chunk("scale", struct.pack("<f", 1.0)) ] + mats + objs)
+    nodes = [ keyframernode("obj%d" % i) for i in xrange(0, objects) for k in xrange(0, keyframes) ]
+    keyf = chunk("keyf3ds", "", [ chunk("kfhdr", struct.pack("<H", 5) + asciz("bench") + struct.pack("<I", 100)) ] + nodes)
+    return chunk("root", "", [ chunk("version", struct.pack("<I", 3)), edit, keyf ]), objects * 2 * (side - 1) * (side - 1), objects
+
+
+def timed(function, *args):
+    # logging is left unconfigured, so the converter stays quiet
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+def convert(tds):
+    if tds2egg.HAVE_PANDA:
+        return tds.toEgg(False)
+    return tds.getTriMeshes()
+
+def write(tds, converted, outfile):
+    if tds2egg.HAVE_PANDA:
+        converted.writeEgg(tds2egg.Filename(outfile))
+        return
+    f = open(outfile, "wb")
+    writer = tds2egg.EggWriter(f)
+    writer.writeMaterials(tds.rootchunk.getMaterials())
+    for name, mesh, mtls in converted:
+        writer.writeMesh(name, mesh, mtls)
+    f.close()
+
+def benchmark(infile, outfile, repeats):
+    """best-of-repeats (read, convert, write) seconds"""
+    best = None
+    for r in xrange(0, repeats):
+        tds = tds2egg.TDSFile()
+        tread, x = timed(tds.read, infile)
+        tconvert, converted = timed(convert, tds)
+        twrite, x = timed(write, tds, converted, outfile)
+        tds.close()
+        if best is None or tread + tconvert + twrite < sum(best):
+            best = (tread, tconvert, twrite)
+    return best
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], "ht:o:m:x:k:f:r:j:", ["help", "keep="])
+    except getopt.error, msg:
+        print msg
+        print __doc__
+        return 2
+    sizes = [ 1000, 10000, 100000, 1000000 ]
+    objects, materials, textured, smoothgroups, keyframes, repeats = 1, 4, 2, 4, 2, 1
+    jsonfile = None
+    keep = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print __doc__
+            return 0
+        elif o == "-t":
+            sizes = [ int(n) for n in a.split(",") ]
+        elif o == "-o":
+            objects = int(a)
+        elif o == "-m":
+            materials = int(a)
+        elif o == "-x":
+            textured = int(a)
+        elif o == "-k":
+            smoothgroups = int(a)
+        elif o == "-f":
+            keyframes = int(a)
+        elif o == "-r":
+            repeats = int(a)
+        elif o == "-j":
+            jsonfile = a
+        elif o == "--keep":
+            keep = a
+    if keep is None:
+        directory = tempfile.mkdtemp(prefix="bench3ds")
+    else:
+        directory = keep
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    results = []
+    print "%10s %10s %10s %9s %9s %9s %12s" % ("triangles", "objects", "bytes", "read", "convert", "write", "tris/sec")
+    try:
+        for size in sizes:
+            data, triangles, nobjects = synthesize(size, objects, materials, textured, smoothgroups, keyframes)
+            infile = os.path.join(directory, "synth%d.3ds" % size)
+            f = open(infile, "wb")
+            f.write(data)
+            f.close()
+            tread, tconvert, twrite = benchmark(infile, os.path.join(directory, "synth%d.egg" % size), repeats)
+            total = tread + tconvert + twrite
+            print "%10d %10d %10d %8.3fs %8.3fs %8.3fs %12.0f" % (triangles, nobjects, len(data), tread, tconvert, twrite, triangles / max(total, 1e-9))
+            results.append({ "triangles": triangles, "objects": nobjects, "bytes": len(data),
+                             "read": tread, "convert": tconvert, "write": twrite, "panda": tds2egg.HAVE_PANDA })
+    finally:
+        if keep is None:
+            shutil.rmtree(directory, True)
+    if jsonfile is not None:
+        f = open(jsonfile, "w")
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+        f.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
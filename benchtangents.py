@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# vim:tabstop=4:shiftwidth=4:syntax=python:expandtab
+"""
+    benchtangents.py filename1.3ds ...
+        times the built-in tangent generator (3ds2egg.py -b) against
+        panda's EggData.recomputeTangentBinormal (3ds2egg.py
+        --pandabinormals) on the same meshes, smoothing group normals
+        and all. without panda, only the built-in side is timed.
+"""
+
+import imp
+import time
+import sys, os
+
+tds2egg = imp.load_source("tds2egg", os.path.join(os.path.dirname(os.path.abspath(__file__)), "3ds2egg.py"))
+
+
+def timebuiltin(filename):
+    """(triangles, seconds) for the built-in generator alone"""
+    tds = tds2egg.TDSFile(filename)
+    tds.smoothnormals = True
+    meshes = tds.getTriMeshes()
+    tris = 0
+    start = time.time()
+    for name, mesh, mtls in meshes:
+        mesh.computeTangents()
+        tris += mesh.getNumTriangles()
+    seconds = time.time() - start
+    tds.close()
+    return tris, seconds
+
+def timepanda(filename):
+    """seconds for panda's recompute over the whole egg, or None"""
+    if not tds2egg.HAVE_PANDA:
+        return None
+    tds = tds2egg.TDSFile(filename)
+    tds.smoothnormals = True
+    egg = tds.toEgg(False)
+    tds.close()
+    start = time.time()
+    egg.recomputeTangentBinormal(tds2egg.GlobPattern(""))
+    return time.time() - start
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    if len(argv) < 2:
+        print __doc__
+        return 2
+    print "%-32s %9s %10s %10s %8s" % ("file", "tris", "builtin", "panda", "speedup")
+    for filename in argv[1:]:
+        tris, builtin = timebuiltin(filename)
+        panda = timepanda(filename)
+        if panda is None:
+            print "%-32s %9d %9.3fs %10s %8s" % (filename, tris, builtin, "-", "-")
+        else:
+            print "%-32s %9d %9.3fs %9.3fs %7.1fx" % (filename, tris, builtin, panda, panda / max(builtin, 1e-9))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())